@@ -0,0 +1,415 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+import multiprocessing
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from cfg import jump_target
+from iter import Iterator, Cursor
+
+import luadec
+import lua4
+import corpus
+import unmunge
+import shared
+import chunkfile
+from shared import Chunk, count_instructions
+from lua4 import OP
+from corpus import instruction, instruction_u, instruction_s
+
+# Synthetic corpora that are benchmarked when no files are given, the same settings give the same files everywhere
+CORPORA = {
+    'flat': corpus.Settings(scripts=200, instructions=100, depth=0, blocks=1),
+    'nested': corpus.Settings(scripts=20, instructions=100, depth=3, functions=3),
+    'control': corpus.Settings(scripts=20, instructions=500, blocks=5, mix={'call': 1, 'if': 2, 'while': 1, 'for': 1}),
+    'large': corpus.Settings(scripts=1, instructions=100000, depth=0, blocks=3, strings=1000, numbers=200),
+    'templates': corpus.Settings(scripts=50, instructions=150, depth=2, functions=4, templates=6),
+}
+
+# Hand-built functions and their expected output, decompiled before any timing: (name, strings, code, lua)
+CASES = [
+    ('local of a block with a call', ['f', 'g'],
+     [instruction_s(OP.PUSHINT, 1), instruction_u(OP.GETGLOBAL, 0), instruction(OP.CALL, 1, 1),
+      instruction_u(OP.POP, 1), instruction_u(OP.GETGLOBAL, 1), instruction_u(OP.GETLOCAL, 0),
+      instruction(OP.CALL, 0, 1)],
+     'local l0 = 1\nlocal l1 = f()\ng(l0)\n'),
+    ('all locals of a block', ['f'],
+     [instruction_s(OP.PUSHINT, 2), instruction_u(OP.POP, 1), instruction_s(OP.PUSHINT, 3),
+      instruction_u(OP.GETGLOBAL, 0), instruction_u(OP.GETLOCAL, 0), instruction(OP.CALL, 0, 1)],
+     'local l0 = 2\nlocal l0 = 3\nf(l0)\n'),
+    ('assignment to a local', ['f'],
+     [instruction_u(OP.GETGLOBAL, 0), instruction(OP.CALL, 1, 0), instruction_u(OP.GETLOCAL, 0),
+      instruction_s(OP.ADDI, 1), instruction_u(OP.SETLOCAL, 0), instruction_u(OP.GETGLOBAL, 0),
+      instruction_u(OP.GETLOCAL, 0), instruction(OP.CALL, 0, 1)],
+     'local l0 = f()\nl0 = (l0 + 1)\nf(l0)\n'),
+    ('if else', ['x', 'f', 'g'],
+     [instruction_u(OP.GETGLOBAL, 0), instruction_s(OP.JMPF, 3), instruction_u(OP.GETGLOBAL, 1),
+      instruction(OP.CALL, 0, 0), instruction_s(OP.JMP, 2), instruction_u(OP.GETGLOBAL, 2), instruction(OP.CALL, 0, 0)],
+     'if x then\n  f()\nelse\n  g()\nend\n'),
+    ('while', ['x', 'f'],
+     [instruction_u(OP.GETGLOBAL, 0), instruction_s(OP.JMPF, 3), instruction_u(OP.GETGLOBAL, 1),
+      instruction(OP.CALL, 0, 0), instruction_s(OP.JMP, -5)],
+     'while x do\n  f()\nend\n'),
+    ('for', ['f'],
+     [instruction_s(OP.PUSHINT, 1), instruction_s(OP.PUSHINT, 10), instruction_s(OP.PUSHINT, 1),
+      instruction_s(OP.FORPREP, 3), instruction_u(OP.GETGLOBAL, 0), instruction_u(OP.GETLOCAL, 0),
+      instruction(OP.CALL, 0, 3), instruction_s(OP.FORLOOP, -4)],
+     'for l0 = 1, 10 do\n  f(l0)\nend\n'),
+    ('or condition', ['a', 'b', 'f'],
+     [instruction_u(OP.GETGLOBAL, 0), instruction_s(OP.JMPT, 2), instruction_u(OP.GETGLOBAL, 1),
+      instruction_s(OP.JMPF, 2), instruction_u(OP.GETGLOBAL, 2), instruction(OP.CALL, 0, 0)],
+     'if (a or b) then\n  f()\nend\n'),
+    ('comparison or test with else', ['a', 'b', 'f', 'g'],
+     [instruction_u(OP.GETGLOBAL, 0), instruction_u(OP.PUSHNIL, 1), instruction_s(OP.JMPEQ, 2),
+      instruction_u(OP.GETGLOBAL, 1), instruction_s(OP.JMPF, 3), instruction_u(OP.GETGLOBAL, 2),
+      instruction(OP.CALL, 0, 0), instruction_s(OP.JMP, 2), instruction_u(OP.GETGLOBAL, 3), instruction(OP.CALL, 0, 0)],
+     'if (a == nil or b) then\n  f()\nelse\n  g()\nend\n'),
+    ('reserved word as key', ['t', 'end', 'x'],
+     [instruction_u(OP.GETGLOBAL, 0), instruction_u(OP.PUSHSTRING, 1), instruction_s(OP.PUSHINT, 1),
+      instruction(OP.SETTABLE, 3, 3), instruction_u(OP.CREATETABLE, 1), instruction_u(OP.PUSHSTRING, 1),
+      instruction_s(OP.PUSHINT, 2), instruction_u(OP.SETMAP, 1), instruction_u(OP.SETGLOBAL, 2)],
+     't["end"] = 1\nx = {["end"] = 2}\n'),
+]
+
+
+def case_chunk(strings: list, code: list) -> Chunk:
+    return Chunk('', 0, 0, False, 16, [], [], strings, [], [], code + [instruction(OP.END)])
+
+
+def check_cases() -> int:
+    # A benchmark of wrong output is worthless, so the run fails on any difference
+    failed = 0
+    for name, strings, code, expected in CASES:
+        text = lua4.render(luadec.process_chunk(case_chunk(strings, code))).strip() + '\n'
+        if text != expected:
+            print(f'check {name}: expected\n{expected}got\n{text}')
+            failed += 1
+
+    # The extra arguments of a variadic function are the local 'arg' after the parameters
+    nested = case_chunk(['f'], [instruction_u(OP.GETGLOBAL, 0), instruction_u(OP.GETLOCAL, 1),
+                                instruction(OP.CALL, 0, 1)])
+    nested.parameters, nested.variadic = 1, True
+    chunk = case_chunk(['g'], [instruction(OP.CLOSURE, 0, 0), instruction_u(OP.SETGLOBAL, 0)])
+    chunk.functions = [nested]
+    expected = 'function g(p0,...)\n  f(arg)\nend\n'
+    text = lua4.render(luadec.process_chunk(chunk)).strip() + '\n'
+    if text != expected:
+        print(f'check variadic function: expected\n{expected}got\n{text}')
+        failed += 1
+
+    return failed
+
+
+def check_cache() -> int:
+    # Nested functions from the cache are indented again line by line, the output must not change by that. The
+    # string constant has characters that str.splitlines treats as line breaks
+    call = [instruction_u(OP.GETGLOBAL, 0), instruction_u(OP.PUSHSTRING, 1), instruction(OP.CALL, 0, 0)]
+    nested = case_chunk(['f', 'a\x85b\x0bc\x1cd\ne'], call * (luadec.MIN_CACHED_INSTRUCTIONS // 3 + 1))
+    chunk = case_chunk(['g'], [instruction(OP.CLOSURE, 0, 0), instruction_u(OP.SETGLOBAL, 0)])
+    chunk.functions = [nested]
+
+    texts = []
+    with tempfile.TemporaryDirectory() as folder:
+        for cache_folder in (None, folder, folder):
+            luadec.configure_cache(cache_folder, 1 << 20)
+            luadec.bodies.clear()
+            texts.append(lua4.render(luadec.process_chunk(chunk)))
+    luadec.configure_cache(None, 0)
+
+    if texts[1] != texts[0] or texts[2] != texts[0]:
+        print(f'check cache: expected\n{texts[0]}got\n{texts[2]}')
+        return 1
+    return 0
+
+
+def bench_unmunge(file: Path, repeat: int = 3) -> float:
+    size = file.stat().st_size
+    best = float('inf')
+
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            unmunge.main(file, Path(folder))
+            best = min(best, time.perf_counter() - start)
+
+    print(f'unmunge {file.name}: {size / 1e6:.2f} MB in {best:.3f} s ({size / 1e6 / best:.2f} MB/s)')
+    return size / 1e6 / best
+
+
+def walk_iterator(code: list) -> int:
+    # The loop of the decompiler before the cursor: StopIteration ends the walk, jump targets are reached step by step
+    n = 0
+    it = Iterator(code)
+    try:
+        while True:
+            instruction = it.next()
+            target = jump_target(instruction)
+            if target is not None and 0 <= target < len(code):
+                pc = instruction.pc
+                while pc < target:
+                    pc = it.next().pc
+                while pc > target:
+                    pc = it.prev().pc
+                n += it.get().op
+                while pc < instruction.pc:
+                    pc = it.next().pc
+                while pc > instruction.pc:
+                    pc = it.prev().pc
+    except StopIteration:
+        pass
+    return n
+
+
+def walk_cursor(code: list) -> int:
+    n = 0
+    cursor = Cursor(code)
+    while cursor:
+        instruction = code[cursor.pc]
+        cursor.pc += 1
+        target = jump_target(instruction)
+        if target is not None:
+            if 0 <= target < cursor.end:
+                n += cursor.seek(target).op
+            cursor.seek(instruction.pc + 1)
+    return n
+
+
+def bench_cursor(files: [Path], repeat: int = 3):
+    codes = []
+    for file in files:
+        with open(file, 'rb') as f:
+            chunks = [chunkfile.load(f)]
+        while chunks:
+            chunk = chunks.pop()
+            codes.append(lua4.decode(chunk))
+            chunks.extend(chunk.functions)
+    instructions = sum(len(x) for x in codes)
+
+    for name, walk in (('Iterator', walk_iterator), ('Cursor', walk_cursor)):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for code in codes:
+                walk(code)
+            best = min(best, time.perf_counter() - start)
+
+        print(f'{name:<8} {instructions} instructions in {best:.3f} s ({instructions / best:,.0f} instr/s)')
+
+
+def bench_luadec(files: [Path], repeat: int = 3) -> float:
+    instructions = 0
+    best = float('inf')
+
+    for _ in range(repeat):
+        chunks = []
+        for file in files:
+            with open(file, 'rb') as f:
+                chunks.append(chunkfile.load(f))
+        instructions = sum(count_instructions(x) for x in chunks)
+
+        # Equal nested functions are decompiled once per run, not once for all runs
+        luadec.bodies.clear()
+        start = time.perf_counter()
+        failed = []
+        for file, chunk in zip(files, chunks):
+            try:
+                luadec.process_chunk(chunk)
+            except Exception as e:
+                failed.append(f'{file}: {type(e).__name__}: {e}')
+                instructions -= count_instructions(chunk)
+        best = min(best, time.perf_counter() - start)
+
+    # Only the files that were decompiled count for the throughput
+    for error in failed:
+        print(error)
+    print(f'luadec {len(files) - len(failed)} files: {instructions} instructions in {best:.3f} s '
+          f'({instructions / best:,.0f} instr/s){f", {len(failed)} failed" if failed else ""}')
+    return instructions / best
+
+
+def peak_rss() -> int:
+    # On Linux ru_maxrss keeps the peak of the parent process across exec, VmHWM only covers this process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes, except on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def measure_decompile(file: Path, connection):
+    with open(file, 'rb') as f:
+        chunk = chunkfile.load(f)
+    instructions = count_instructions(chunk)
+    loaded = peak_rss()
+
+    with open(os.devnull, 'w') as output:
+        start = time.perf_counter()
+        luadec.process_chunk(chunk).emit(lua4.Emitter(output))
+        elapsed = time.perf_counter() - start
+        rss = peak_rss()
+
+        luadec.bodies.clear()
+        tracemalloc.start()
+        luadec.process_chunk(chunk).emit(lua4.Emitter(output))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    connection.send((instructions, elapsed, loaded, rss, peak))
+
+
+def bench_memory(file: Path):
+    # Runs in a fresh process, so the peak RSS only covers loading and decompiling the one file
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context('spawn').Process(target=measure_decompile, args=(file, sender))
+    process.start()
+    instructions, elapsed, loaded, rss, peak = receiver.recv()
+    process.join()
+
+    print(f'luadec {file.name}: {instructions} instructions in {elapsed:.3f} s ({instructions / elapsed:,.0f} instr/s), '
+          f'peak RSS {rss / 1e6:.1f} MB ({loaded / 1e6:.1f} MB after loading), '
+          f'peak allocated while decompiling {peak / 1e6:.1f} MB')
+    return rss / 1e6
+
+
+def parse_scripts(files: [Path]) -> list:
+    chunks = []
+    for file in files:
+        r = unmunge.open_reader(file)
+        for chunk_name, offset, chunk_size, script_name, digest in unmunge.read_ucfb(r):
+            if chunk_name == 'scr_':
+                r.pos = offset + 8
+                chunks.append(unmunge.read_scr_(r)[2])
+    return chunks
+
+
+def load_chunks(files: [Path]) -> list:
+    chunks = []
+    for file in files:
+        with open(file, 'rb') as f:
+            chunks.append(chunkfile.load(f))
+    return chunks
+
+
+def allocated(load, files: [Path], interned: bool) -> int:
+    # Memory held by the loaded chunks, the string pool included
+    shared.configure_interning(interned)
+    tracemalloc.start()
+    chunks = load(files)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del chunks
+    shared.configure_interning(True)
+    return size
+
+
+def bench_interning(script_files: [Path], dat_files: [Path]) -> float:
+    loaded = 0
+    for name, load, files in (('parsed', parse_scripts, script_files), ('loaded', load_chunks, dat_files)):
+        if files:
+            without = allocated(load, files, False)
+            loaded = allocated(load, files, True)
+            print(f'{name} {len(files)} files: {without / 1e6:.2f} MB, {loaded / 1e6:.2f} MB with shared strings '
+                  f'({1 - loaded / without:.0%} less)')
+    return loaded / 1e6
+
+
+def bench_corpus(name: str, settings: corpus.Settings, folder: Path) -> dict:
+    data, instructions = corpus.generate(settings)
+    file = folder / f'{name}.script'
+    file.write_bytes(data)
+    print(f'{name}: {settings.scripts} scripts, {instructions} instructions, {len(data) / 1e6:.2f} MB')
+
+    results = {f'{name} unmunge MB/s': bench_unmunge(file)}
+
+    (folder / name).mkdir()
+    with contextlib.redirect_stdout(io.StringIO()):
+        unmunge.main(file, folder / name)
+    dat_files = sorted((folder / name).glob('*.dat'))
+
+    results[f'{name} luadec peak RSS MB'] = bench_memory(max(dat_files, key=lambda x: x.stat().st_size))
+    results[f'{name} luadec instr/s'] = bench_luadec(dat_files)
+    results[f'{name} loaded MB'] = bench_interning([file], dat_files)
+    print()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> int:
+    # Throughput is worse when it is lower, memory when it is higher
+    regressions = 0
+    print(f'{"":<32} {"baseline":>14} {"now":>14} {"change":>8}')
+
+    for name, value in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+
+        change = value / old - 1
+        worse = change if name.endswith(' MB') else -change
+        regression = worse > tolerance
+        regressions += regression
+        print(f'{name:<32} {old:>14,.2f} {value:>14,.2f} {change:>+8.1%}{"  regression" if regression else ""}')
+
+    print(f'{regressions} regressions of more than {tolerance:.0%}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Prints the best of 3 unmunge timings for each script file and the best of 3 instruction walk '
+                    'and decompile timings over all dat files, and the time and memory of decompiling the largest '
+                    'dat file. Without files, synthetic corpora are generated and benchmarked (see corpus.py).')
+    parser.add_argument('files', nargs='*', help='\'*.script\' or \'*.dat\' files')
+    parser.add_argument('--baseline', metavar='FILE', help='compare the corpus results with the results in FILE')
+    parser.add_argument('--save', metavar='FILE', help='store the corpus results in FILE as a baseline')
+    parser.add_argument('--tolerance', type=float, default=10.0, metavar='PERCENT',
+                        help='with --baseline, changes for the worse above PERCENT are regressions')
+
+    args = parser.parse_args()
+    files = [Path(x) for x in args.files]
+
+    if check_cases() + check_cache():
+        exit(1)
+
+    for file in files:
+        if file.suffix != '.dat':
+            bench_unmunge(file)
+
+    dat_files = [x for x in files if x.suffix == '.dat']
+    if dat_files:
+        bench_memory(max(dat_files, key=lambda x: x.stat().st_size))
+        bench_cursor(dat_files)
+        bench_luadec(dat_files)
+        bench_interning([], dat_files)
+
+    if not files:
+        results = {}
+        with tempfile.TemporaryDirectory() as folder:
+            for name, settings in CORPORA.items():
+                results.update(bench_corpus(name, settings, Path(folder)))
+
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                if compare(results, json.load(f), args.tolerance / 100):
+                    exit(1)
@@ -0,0 +1,147 @@
+import os
+import time
+import array
+import struct
+import hashlib
+import tempfile
+from pathlib import Path
+
+from shared import Chunk
+
+
+def chunk_hash(chunk: Chunk) -> bytes:
+    # Hash of everything the decompiled output depends on. Names, line numbers and locals are left out,
+    # so equal functions of different files have the same hash
+    value = getattr(chunk, 'hash', None)
+    if value is not None:
+        return value
+
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(struct.pack('<2I', chunk.parameters, int(chunk.variadic)))
+
+    digest.update(struct.pack('<I', len(chunk.strings)))
+    for string in chunk.strings:
+        data = string.encode('latin-1')
+        digest.update(struct.pack('<I', len(data)))
+        digest.update(data)
+
+    digest.update(struct.pack(f'<I{len(chunk.numbers)}f', len(chunk.numbers), *chunk.numbers))
+
+    digest.update(struct.pack('<I', len(chunk.functions)))
+    for function in chunk.functions:
+        digest.update(chunk_hash(function))
+
+    instructions = chunk.instructions
+    if not isinstance(instructions, memoryview):
+        instructions = array.array('I', instructions)
+    digest.update(struct.pack('<I', len(instructions)))
+    digest.update(instructions)
+
+    chunk.hash = digest.digest()
+    return chunk.hash
+
+
+def key(*parts) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode('utf-8')
+        digest.update(struct.pack('<I', len(data)))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+# Decompiled scripts in files named by their key. When the total size exceeds max_size the least recently
+# used files are removed. Several processes can share the folder, files are replaced atomically.
+class Cache:
+    def __init__(self, folder: Path, max_size: int):
+        self.folder = Path(folder)
+        self.max_size = max_size
+        self.entries = None  # key: [size, last use], read from the folder by the first put
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def scan(self):
+        self.entries = {}
+        self.size = 0
+        for directory in os.scandir(self.folder):
+            if directory.is_dir():
+                for file in os.scandir(directory.path):
+                    if file.name.endswith('.lua'):
+                        try:
+                            stat = file.stat()
+                        except OSError:
+                            # Removed by another process
+                            continue
+                        self.entries[file.name[:-4]] = [stat.st_size, stat.st_mtime]
+                        self.size += stat.st_size
+
+    def path(self, key: str) -> Path:
+        return self.folder / key[:2] / f'{key}.lua'
+
+    def get(self, key: str):
+        path = self.path(key)
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+
+        except OSError:
+            self.misses += 1
+            return None
+
+        # The modification time is the last use. A read-only cache or a file removed meanwhile is still a hit
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.hits += 1
+        if self.entries is not None:
+            # Sizes are in bytes like those of scan
+            size = len(text.encode('utf-8'))
+            if key not in self.entries:
+                self.size += size
+            self.entries[key] = [size, time.time()]
+        return text
+
+    def put(self, key: str, text: str):
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True)
+
+        handle, temporary = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        with os.fdopen(handle, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temporary, path)
+
+        if self.entries is None:
+            self.scan()
+        size = len(text.encode('utf-8'))
+        if key in self.entries:
+            self.size -= self.entries[key][0]
+        self.entries[key] = [size, time.time()]
+        self.size += size
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        # Down to 90 % of the limit, so the entries are not sorted again for every new file
+        for key, (size, _) in sorted(self.entries.items(), key=lambda x: x[1][1]):
+            if self.size <= self.max_size * 0.9:
+                break
+
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+            del self.entries[key]
+            self.size -= size
+
+    def __str__(self):
+        if self.entries is None:
+            self.scan()
+        return f'cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} files, {self.size / 1e6:.1f} MB'
@@ -0,0 +1,246 @@
+from bisect import bisect_right
+
+from lua4 import OP, Instruction
+
+# Jumps are relative to the next instruction, S is one less than the offset (see PUSHINT in luadec.build_stack)
+JUMPS = {
+    OP.JMPNE, OP.JMPEQ, OP.JMPLT, OP.JMPLE, OP.JMPGT, OP.JMPGE, OP.JMPT, OP.JMPF, OP.JMPONT, OP.JMPONF,
+    OP.JMP, OP.FORLOOP, OP.LFORLOOP
+}
+
+# The empty loop jump of FORPREP/LFORPREP also skips the FORLOOP/LFORLOOP instruction
+FOR_PREPARATIONS = {OP.FORPREP, OP.LFORPREP}
+
+CONDITIONAL_JUMPS = (JUMPS - {OP.JMP}) | FOR_PREPARATIONS
+
+TERMINATORS = {OP.END, OP.RETURN, OP.TAILCALL}
+
+
+def jump_target(instruction: Instruction):
+    if instruction.op in JUMPS:
+        return instruction.pc + instruction.s + 2
+
+    if instruction.op in FOR_PREPARATIONS:
+        return instruction.pc + instruction.s + 3
+
+    return None
+
+
+class Block:
+    def __init__(self, index: int, start: int, end: int):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.successors = []
+        self.predecessors = []
+
+    def __repr__(self):
+        return f'Block({self.index}, {self.start}:{self.end} -> {[x.index for x in self.successors]})'
+
+
+class CFG:
+    def __init__(self, code: [Instruction]):
+        self.code = code
+        self.blocks = []
+        self.starts = []
+
+        self.split()
+        self.connect()
+
+        self.idom = dominators(self.blocks)
+        self.ipdom = post_dominators(self.blocks)
+        self.dominator_tree = intervals(self.idom)
+        self.post_dominator_tree = intervals(self.ipdom)
+
+        # Back edges (latch -> header) of the natural loops, keyed by the header start
+        self.loops = {}
+        for block in self.blocks:
+            for successor in block.successors:
+                if successor.start <= block.start and self.dominates(successor, block):
+                    self.loops.setdefault(successor.start, []).append(block)
+
+    def split(self):
+        n = len(self.code)
+        leaders = [False] * (n + 1)
+        leaders[0] = True
+
+        for instruction in self.code:
+            pc = instruction.pc
+            target = jump_target(instruction)
+
+            if target is not None:
+                if 0 <= target < n:
+                    leaders[target] = True
+                leaders[pc + 1] = True
+
+            elif instruction.op in TERMINATORS:
+                leaders[pc + 1] = True
+
+            elif instruction.op == OP.PUSHNILJMP:
+                leaders[pc + 1] = True
+                leaders[min(pc + 2, n)] = True
+
+        start = 0
+        for pc in range(1, n + 1):
+            if leaders[pc] or pc == n:
+                self.blocks.append(Block(len(self.blocks), start, pc))
+                self.starts.append(start)
+                start = pc
+
+    def connect(self):
+        n = len(self.code)
+
+        for block in self.blocks:
+            last = self.code[block.end - 1]
+            target = jump_target(last)
+
+            if last.op == OP.JMP:
+                targets = [target]
+            elif last.op in CONDITIONAL_JUMPS:
+                targets = [block.end, target]
+            elif last.op == OP.PUSHNILJMP:
+                targets = [last.pc + 2]
+            elif last.op in TERMINATORS:
+                targets = []
+            else:
+                targets = [block.end]
+
+            for pc in targets:
+                if 0 <= pc < n:
+                    successor = self.block_of(pc)
+                    if successor not in block.successors:
+                        block.successors.append(successor)
+                        successor.predecessors.append(block)
+
+    def block_of(self, pc: int) -> Block:
+        return self.blocks[bisect_right(self.starts, pc) - 1]
+
+    def dominates(self, a: Block, b: Block) -> bool:
+        return dominates(self.dominator_tree, a.index, b.index)
+
+    def post_dominates(self, a: Block, b: Block) -> bool:
+        return dominates(self.post_dominator_tree, a.index, b.index)
+
+    def join(self, block: Block):
+        # First instruction reached by every path leaving the block, None if the paths never meet again
+        index = self.ipdom[block.index]
+        if index is None or index == len(self.blocks):
+            return None
+        return self.blocks[index].start
+
+
+def intervals(idom: list) -> (list, list):
+    # Entry and exit numbers of a depth-first walk of the dominator tree, a node dominates the nodes
+    # whose interval lies within its own. Nodes that are not reachable have no interval
+    children = [[] for _ in idom]
+    roots = []
+    for node, parent in enumerate(idom):
+        if parent == node:
+            roots.append(node)
+        elif parent is not None:
+            children[parent].append(node)
+
+    enter = [None] * len(idom)
+    leave = [None] * len(idom)
+    counter = 0
+    stack = [(x, False) for x in roots]
+
+    while stack:
+        node, done = stack.pop()
+        if done:
+            leave[node] = counter
+            counter += 1
+            continue
+
+        enter[node] = counter
+        counter += 1
+        stack.append((node, True))
+        stack.extend((x, False) for x in children[node])
+
+    return enter, leave
+
+
+def dominates(tree: (list, list), a: int, b: int) -> bool:
+    enter, leave = tree
+    if enter[a] is None or enter[b] is None:
+        return False
+    return enter[a] <= enter[b] and leave[b] <= leave[a]
+
+
+def reverse_postorder(successors: list, entry: int) -> list:
+    order = []
+    visited = [False] * len(successors)
+    visited[entry] = True
+    stack = [(entry, iter(successors[entry]))]
+
+    while stack:
+        node, children = stack[-1]
+        for child in children:
+            if not visited[child]:
+                visited[child] = True
+                stack.append((child, iter(successors[child])))
+                break
+        else:
+            stack.pop()
+            order.append(node)
+
+    order.reverse()
+    return order
+
+
+def immediate_dominators(successors: list, predecessors: list, entry: int) -> list:
+    # Cooper, Harvey, Kennedy: "A Simple, Fast Dominance Algorithm"
+    order = reverse_postorder(successors, entry)
+    rank = [None] * len(successors)
+    for i, node in enumerate(order):
+        rank[node] = i
+
+    idom = [None] * len(successors)
+    idom[entry] = entry
+
+    def intersect(a, b):
+        while a != b:
+            while rank[a] > rank[b]:
+                a = idom[a]
+            while rank[b] > rank[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for node in order[1:]:
+            new = None
+            for predecessor in predecessors[node]:
+                if idom[predecessor] is not None:
+                    new = predecessor if new is None else intersect(predecessor, new)
+
+            if new != idom[node]:
+                idom[node] = new
+                changed = True
+
+    return idom
+
+
+def dominators(blocks: [Block]) -> list:
+    if not blocks:
+        return []
+
+    successors = [[x.index for x in block.successors] for block in blocks]
+    predecessors = [[x.index for x in block.predecessors] for block in blocks]
+
+    return immediate_dominators(successors, predecessors, 0)
+
+
+def post_dominators(blocks: [Block]) -> list:
+    # Dominators of the reversed graph, with a virtual exit after every block without successors
+    exit = len(blocks)
+    successors = [[x.index for x in block.predecessors] for block in blocks] + [[]]
+    predecessors = [[x.index for x in block.successors] for block in blocks] + [[]]
+
+    for block in blocks:
+        if not block.successors:
+            successors[exit].append(block.index)
+            predecessors[block.index].append(exit)
+
+    return immediate_dominators(successors, predecessors, exit)
@@ -0,0 +1,249 @@
+import io
+import sys
+import mmap
+import array
+import struct
+import pickle
+
+from shared import Chunk, LazyChunk, LazyList, intern
+
+# Layout (little-endian, every section starts 4-byte aligned):
+#   header
+#   function records       functions * FUNCTION, the root function first
+#   string offsets         (strings + 1) * uint32 into the string data
+#   blob offsets           (blobs + 1) * uint32 into the blob data
+#   numbers                numbers * float32
+#   words                  words * uint32, instructions and the index lists of the function records
+#   string data            latin-1
+#   blob data              raw locals and lines
+MAGIC = b'LDCF'
+VERSION = 1
+
+HEADER = struct.Struct('<4s6I')
+FUNCTION = struct.Struct('<17I')
+
+
+class Writer:
+    def __init__(self):
+        self.functions = []
+        self.strings = {}
+        self.blobs = []
+        self.numbers = {}
+        self.words = array.array('I')
+
+    def string(self, value: str) -> int:
+        return self.strings.setdefault(value, len(self.strings))
+
+    def number(self, value: float) -> int:
+        return self.numbers.setdefault(struct.pack('<f', value), len(self.numbers))
+
+    def indices(self, values) -> (int, int):
+        offset = len(self.words)
+        self.words.extend(values)
+        return offset, len(values)
+
+    def blob_indices(self, values) -> (int, int):
+        offset = len(self.blobs)
+        self.blobs.extend(bytes(x) for x in values)
+        return self.indices(range(offset, offset + len(values)))
+
+    def add(self, chunk: Chunk) -> int:
+        index = len(self.functions)
+        self.functions.append(None)
+
+        functions = [self.add(x) for x in chunk.functions]
+
+        self.functions[index] = (
+            self.string(chunk.name), chunk.line, chunk.parameters, int(chunk.variadic), chunk.stacks,
+            *self.blob_indices(chunk.locals),
+            *self.blob_indices(chunk.lines),
+            *self.indices([self.string(x) for x in chunk.strings]),
+            *self.indices([self.number(x) for x in chunk.numbers]),
+            *self.indices(functions),
+            *self.indices(chunk.instructions))
+
+        return index
+
+    def data(self) -> bytes:
+        strings = [x.encode('latin-1') for x in self.strings]
+
+        words = array.array('I', self.words)
+        if sys.byteorder != 'little':
+            words.byteswap()
+
+        return b''.join([
+            HEADER.pack(MAGIC, VERSION, len(self.functions), len(strings), len(self.blobs), len(self.numbers),
+                        len(words)),
+            b''.join(FUNCTION.pack(*x) for x in self.functions),
+            offsets(strings),
+            offsets(self.blobs),
+            b''.join(self.numbers),
+            words.tobytes(),
+            aligned(b''.join(strings)),
+            b''.join(self.blobs)
+        ])
+
+
+def offsets(values: list) -> bytes:
+    result = [0]
+    for value in values:
+        result.append(result[-1] + len(value))
+    return struct.pack(f'<{len(result)}I', *result)
+
+
+def aligned(data: bytes) -> bytes:
+    return data + bytes(-len(data) % 4)
+
+
+def uint32s(view: memoryview, pos: int, n: int):
+    # The instruction and index lists are views on the buffer, unless the byte order needs a copy
+    if sys.byteorder == 'little':
+        return view[pos:pos + 4 * n].cast('I')
+    return array.array('I', struct.unpack_from(f'<{n}I', view, pos))
+
+
+def dumps(chunk: Chunk) -> bytes:
+    writer = Writer()
+    writer.add(chunk)
+    return writer.data()
+
+
+class Container:
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        magic, version, num_functions, num_strings, num_blobs, num_numbers, num_words = HEADER.unpack_from(view, 0)
+
+        if magic != MAGIC:
+            raise ValueError('Not a binary chunk file')
+
+        if version != VERSION:
+            raise ValueError(f'Unsupported binary chunk version {version}')
+
+        pos = HEADER.size
+        self.records = view[pos:pos + FUNCTION.size * num_functions]
+        self.num_functions = num_functions
+        pos += FUNCTION.size * num_functions
+
+        self.string_offsets = struct.unpack_from(f'<{num_strings + 1}I', view, pos)
+        pos += 4 * (num_strings + 1)
+
+        self.blob_offsets = struct.unpack_from(f'<{num_blobs + 1}I', view, pos)
+        pos += 4 * (num_blobs + 1)
+
+        self.numbers = struct.unpack_from(f'<{num_numbers}f', view, pos)
+        pos += 4 * num_numbers
+
+        self.words = uint32s(view, pos, num_words)
+        pos += 4 * num_words
+
+        self.string_data = view[pos:pos + self.string_offsets[-1]]
+        self.strings = [None] * num_strings
+        pos += self.string_offsets[-1] + -self.string_offsets[-1] % 4
+
+        self.blob_data = view[pos:pos + self.blob_offsets[-1]]
+
+    def string(self, index: int) -> str:
+        value = self.strings[index]
+        if value is None:
+            value = intern(str(self.string_data[self.string_offsets[index]:self.string_offsets[index + 1]], 'latin-1'))
+            self.strings[index] = value
+        return value
+
+    def all_strings(self) -> list:
+        # latin-1 maps every byte to one character, so the whole string pool is decoded at once and sliced
+        data = str(self.string_data, 'latin-1')
+        offsets = self.string_offsets
+        self.strings = [intern(data[start:end]) for start, end in zip(offsets, offsets[1:])]
+        return self.strings
+
+    def blobs(self, offset: int, n: int) -> list:
+        if not n:
+            return []
+        offsets = self.blob_offsets
+        return [bytearray(self.blob_data[offsets[i]:offsets[i + 1]]) for i in self.words[offset:offset + n]]
+
+    def chunks(self) -> Chunk:
+        strings = self.all_strings()
+        numbers = self.numbers
+        words = self.words
+
+        # Nested functions are always stored after their parent, so the tree is built from the back
+        chunks = [None] * self.num_functions
+        for index, record in reversed(list(enumerate(FUNCTION.iter_unpack(self.records)))):
+            name, line, parameters, variadic, stacks, \
+                locals_offset, num_locals, lines_offset, num_lines, \
+                strings_offset, num_strings, numbers_offset, num_numbers, \
+                functions_offset, num_functions, instructions_offset, num_instructions = record
+
+            chunks[index] = Chunk(
+                strings[name], line, parameters, variadic == 1, stacks,
+                self.blobs(locals_offset, num_locals),
+                self.blobs(lines_offset, num_lines),
+                list(map(strings.__getitem__, words[strings_offset:strings_offset + num_strings])),
+                list(map(numbers.__getitem__, words[numbers_offset:numbers_offset + num_numbers])),
+                list(map(chunks.__getitem__, words[functions_offset:functions_offset + num_functions])),
+                words[instructions_offset:instructions_offset + num_instructions])
+
+        return chunks[0]
+
+    def lazy_chunk(self, index: int = 0) -> LazyChunk:
+        name, line, parameters, variadic, stacks, \
+            locals_offset, num_locals, lines_offset, num_lines, \
+            strings_offset, num_strings, numbers_offset, num_numbers, \
+            functions_offset, num_functions, instructions_offset, num_instructions = \
+            FUNCTION.unpack_from(self.records, index * FUNCTION.size)
+
+        words = self.words
+
+        return LazyChunk(self.string(name), line, parameters, variadic == 1, stacks, {
+            'locals': lambda: self.blobs(locals_offset, num_locals),
+            'lines': lambda: self.blobs(lines_offset, num_lines),
+            'strings': lambda: list(map(self.string, words[strings_offset:strings_offset + num_strings])),
+            'numbers': lambda: list(map(self.numbers.__getitem__, words[numbers_offset:numbers_offset + num_numbers])),
+            'functions': lambda: LazyList(num_functions, lambda i: self.lazy_chunk(words[functions_offset + i])),
+            'instructions': lambda: words[instructions_offset:instructions_offset + num_instructions]
+        })
+
+
+def loads(buffer, lazy: bool = False) -> Chunk:
+    container = Container(buffer)
+
+    if lazy:
+        return container.lazy_chunk()
+
+    return container.chunks()
+
+
+def dump(chunk: Chunk, file):
+    file.write(dumps(chunk))
+
+
+# Pickled files may only contain Chunk structures, any other class could run code while the file is loaded
+class ChunkUnpickler(pickle.Unpickler):
+    ALLOWED = {('shared', 'Chunk'), ('builtins', 'list'), ('builtins', 'bytearray')}
+
+    def find_class(self, module, name):
+        if (module, name) not in self.ALLOWED:
+            raise pickle.UnpicklingError(f'{module}.{name} is not allowed in a chunk file')
+        return super().find_class(module, name)
+
+
+def load(file, lazy: bool = False) -> Chunk:
+    data = file.read()
+
+    # Files written before the binary format are pickled Chunk structures
+    if data[:4] != MAGIC:
+        return ChunkUnpickler(io.BytesIO(data)).load()
+
+    return loads(data, lazy)
+
+
+def load_mapped(path, lazy: bool = False) -> Chunk:
+    # The file is mapped instead of read, with lazy only the records of the functions that are used are paged in
+    with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if data[:4] != MAGIC:
+        return load(io.BytesIO(data))
+
+    return loads(data, lazy)
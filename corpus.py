@@ -0,0 +1,284 @@
+import sys
+import struct
+import random
+import argparse
+from pathlib import Path
+
+from lua4 import OP
+
+# Statements of the generated functions and their default weights
+MIX = {'call': 4, 'assign': 2, 'arith': 2, 'table': 1, 'if': 1, 'while': 1, 'for': 1}
+
+ARITHMETIC = [OP.ADD, OP.SUB, OP.MULT, OP.DIV]
+COMPARISONS = [OP.JMPNE, OP.JMPEQ, OP.JMPLT, OP.JMPLE, OP.JMPGT, OP.JMPGE]
+
+# Header of a Lua 4.0 chunk as written by SWBF: little-endian, 4-byte int, size_t and instruction,
+# 6 bits for OP, 9 bits for B and 4-byte numbers
+HEADER = b'\x1bLua@' + bytes([1, 4, 4, 4, 32, 6, 9, 4]) + struct.pack('<f', 3.14159265358979323846E8)
+
+INT32 = struct.Struct('<I')
+
+
+def instruction(op: int, b: int = 0, a: int = 0) -> int:
+    return op | (b << 6) | (a << 15)
+
+
+def instruction_u(op: int, u: int) -> int:
+    return op | (u << 6)
+
+
+def instruction_s(op: int, s: int) -> int:
+    # Signed argument, stored with an offset of 2^25 - 1
+    return op | ((s + (1 << 25) - 1) << 6)
+
+
+class Settings:
+    def __init__(self, scripts: int = 10, instructions: int = 200, depth: int = 2, functions: int = 2,
+                 blocks: int = 2, strings: int = 32, numbers: int = 8, mix: dict = None, other: int = 2,
+                 vocabulary: int = 1000, templates: int = 0, seed: int = 1):
+        self.scripts = scripts  # scr_ chunks in the container
+        self.instructions = instructions  # Instructions of every function, approximately
+        self.depth = depth  # Nesting depth of functions
+        self.functions = functions  # Nested functions of every function above the depth
+        self.blocks = blocks  # Nesting depth of if, while and for statements
+        self.strings = max(1, strings)  # String constants of every function
+        self.numbers = numbers  # Number constants of every function
+        self.mix = mix or MIX
+        self.other = other  # Chunks of other types before every scr_ chunk
+        self.vocabulary = max(vocabulary, self.strings)  # Different names of all functions
+        self.templates = templates  # Different nested functions per depth, 0 if all are different
+        self.seed = seed
+
+
+class Function:
+    def __init__(self, name: str, line: int, strings: list, numbers: list, functions: list, code: list):
+        self.name = name
+        self.line = line
+        self.strings = strings
+        self.numbers = numbers
+        self.functions = functions
+        self.code = code
+
+    def instructions(self) -> int:
+        return len(self.code) + sum(x.instructions() for x in self.functions)
+
+
+class Generator:
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.rng = random.Random(settings.seed)
+        self.kinds = list(settings.mix)
+        self.weights = [settings.mix[x] for x in self.kinds]
+        self.templates = {}
+
+    def function(self, depth: int, name: str = '') -> Function:
+        settings = self.settings
+        rng = self.rng
+
+        # Like the global names of the game, the string constants of all functions come from one vocabulary
+        strings = [f'name{i}' for i in rng.sample(range(settings.vocabulary), settings.strings)]
+        numbers = [rng.randint(-4000, 4000) / 4 for _ in range(settings.numbers)]  # Exact as 4-byte floats
+        functions = [self.nested(depth - 1) for _ in range(settings.functions if depth > 0 else 0)]
+
+        self.strings = strings
+        self.numbers = numbers
+
+        # Nested functions are assigned to globals, then come the statements
+        code = []
+        for i in range(len(functions)):
+            code += [instruction(OP.CLOSURE, 0, i), instruction_u(OP.SETGLOBAL, self.string())]
+
+        while len(code) < settings.instructions:
+            code += self.statement(0, settings.blocks, settings.instructions - len(code))
+
+        code.append(instruction(OP.END))
+        return Function(name, rng.randrange(1, 1000), strings, numbers, functions, code)
+
+    def nested(self, depth: int) -> Function:
+        # With templates, nested functions are copies of a few functions, like the event handlers of mission
+        # scripts that are made from the same template
+        if not self.settings.templates:
+            return self.function(depth)
+
+        key = (depth, self.rng.randrange(self.settings.templates))
+        if key not in self.templates:
+            self.templates[key] = self.function(depth)
+        return self.templates[key]
+
+    def string(self) -> int:
+        return self.rng.randrange(len(self.strings))
+
+    def value(self) -> list:
+        rng = self.rng
+        k = rng.randrange(3)
+        if k == 0:
+            return [instruction_u(OP.PUSHSTRING, self.string())]
+        if k == 1 and self.numbers:
+            return [instruction_u(OP.PUSHNUM, rng.randrange(len(self.numbers)))]
+        return [instruction_s(OP.PUSHINT, rng.randint(-100, 1000))]
+
+    def block(self, base: int, depth: int, size: int) -> list:
+        code = []
+        target = self.rng.randint(1, max(1, size))
+        while len(code) < target:
+            code += self.statement(base, depth, target - len(code))
+        return code
+
+    def statement(self, base: int, depth: int, size: int) -> list:
+        # base is the number of locals, the first free stack slot
+        rng = self.rng
+        kind = rng.choices(self.kinds, self.weights)[0]
+        if depth <= 0 and kind in ('if', 'while', 'for'):
+            kind = 'call'
+
+        if kind == 'call':
+            code = [instruction_u(OP.GETGLOBAL, self.string())]
+            for _ in range(rng.randrange(4)):
+                code += self.value()
+            return code + [instruction(OP.CALL, 0, base)]
+
+        if kind == 'assign':
+            return self.value() + [instruction_u(OP.SETGLOBAL, self.string())]
+
+        if kind == 'arith':
+            code = [instruction_u(OP.GETGLOBAL, self.string())]
+            for _ in range(rng.randint(1, 8)):
+                operand = [instruction_u(OP.GETGLOBAL, self.string())] if rng.random() < 0.5 else self.value()
+                code += operand + [instruction(rng.choice(ARITHMETIC))]
+            return code + [instruction_u(OP.SETGLOBAL, self.string())]
+
+        if kind == 'table':
+            if rng.random() < 0.5:
+                # t[k] = v
+                return [instruction_u(OP.GETGLOBAL, self.string()), instruction_u(OP.PUSHSTRING, self.string())] + \
+                    self.value() + [instruction(OP.SETTABLE, 3, 3)]
+
+            values = rng.randint(0, 8)
+            fields = rng.randint(0, 4)
+            code = [instruction_u(OP.CREATETABLE, values + fields)]
+            for _ in range(values):
+                code += self.value()
+            if values:
+                code.append(instruction(OP.SETLIST, values, 0))
+            for _ in range(fields):
+                code += [instruction_u(OP.PUSHSTRING, self.string())] + self.value()
+            if fields:
+                code.append(instruction_u(OP.SETMAP, fields))
+            return code + [instruction_u(OP.SETGLOBAL, self.string())]
+
+        inner = self.block(base + (3 if kind == 'for' else 0), depth - 1, min(size, 40))
+
+        if kind == 'if':
+            condition = [instruction_u(OP.GETGLOBAL, self.string())] + self.value()
+            if rng.random() < 0.5:
+                return condition + [instruction_s(rng.choice(COMPARISONS), len(inner))] + inner
+
+            other = self.block(base, depth - 1, min(size, 40))
+            return condition + [instruction_s(rng.choice(COMPARISONS), len(inner) + 1)] + inner + \
+                [instruction_s(OP.JMP, len(other))] + other
+
+        if kind == 'while':
+            return [instruction_u(OP.GETGLOBAL, self.string()), instruction_s(OP.JMPF, len(inner) + 1)] + inner + \
+                [instruction_s(OP.JMP, -(len(inner) + 3))]
+
+        return [instruction_s(OP.PUSHINT, 1), instruction_s(OP.PUSHINT, rng.randint(2, 100)),
+                instruction_s(OP.PUSHINT, 1), instruction_s(OP.FORPREP, len(inner))] + inner + \
+            [instruction_s(OP.FORLOOP, -(len(inner) + 1))]
+
+
+def dump_string(value: str) -> bytes:
+    data = value.encode('latin-1') + b'\0'
+    return INT32.pack(len(data)) + data
+
+
+def dump_function(function: Function) -> bytes:
+    # Locals and line numbers are empty, like in the scripts of SWBF
+    return b''.join([
+        dump_string(function.name),
+        struct.pack('<2IBI', function.line, 0, 0, 16),
+        INT32.pack(0),
+        INT32.pack(0),
+        INT32.pack(len(function.strings)), *(dump_string(x) for x in function.strings),
+        INT32.pack(len(function.numbers)), struct.pack(f'<{len(function.numbers)}f', *function.numbers),
+        INT32.pack(len(function.functions)), *(dump_function(x) for x in function.functions),
+        INT32.pack(len(function.code)), struct.pack(f'<{len(function.code)}I', *function.code),
+    ])
+
+
+def dump_param(magic: bytes, data: bytes) -> bytes:
+    return magic + INT32.pack(len(data)) + data + b'\0' * (-len(data) % 4)
+
+
+def dump_chunk(magic: bytes, data: bytes) -> bytes:
+    return magic + INT32.pack(len(data)) + data
+
+
+def dump_script(name: str, function: Function) -> bytes:
+    return dump_chunk(b'scr_', b''.join([
+        dump_param(b'NAME', name.encode('latin-1') + b'\0'),
+        dump_param(b'INFO', INT32.pack(1)),
+        dump_param(b'BODY', HEADER + dump_function(function)),
+    ]))
+
+
+def generate(settings: Settings) -> (bytes, int):
+    # A ucfb container with the scr_ chunks, and the number of instructions in them
+    generator = Generator(settings)
+    rng = generator.rng
+    parts = []
+    instructions = 0
+
+    for i in range(settings.scripts):
+        for _ in range(settings.other):
+            size = 4 * rng.randint(1, 256)
+            parts.append(dump_chunk(b'tex_', rng.getrandbits(8 * size).to_bytes(size, 'little')))
+
+        function = generator.function(settings.depth, f'@script{i}.lua')
+        instructions += function.instructions()
+        parts.append(dump_script(f'script{i}', function))
+
+    return dump_chunk(b'ucfb', b''.join(parts)), instructions
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(','):
+        kind, weight = item.split('=')
+        if kind not in MIX:
+            raise argparse.ArgumentTypeError(f'unknown statement \'{kind}\', one of {", ".join(MIX)}')
+        mix[kind] = float(weight)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generates a \'*.script\' file with random Lua 4.0 scripts for benchmarks and tests.')
+    parser.add_argument('file', help='output \'*.script\' file')
+    parser.add_argument('--scripts', type=int, default=10, help='number of \'scr_\' chunks')
+    parser.add_argument('--instructions', type=int, default=200, help='instructions of every function')
+    parser.add_argument('--depth', type=int, default=2, help='nesting depth of functions')
+    parser.add_argument('--functions', type=int, default=2, help='nested functions of every function')
+    parser.add_argument('--blocks', type=int, default=2, help='nesting depth of if, while and for statements')
+    parser.add_argument('--strings', type=int, default=32, help='string constants of every function')
+    parser.add_argument('--numbers', type=int, default=8, help='number constants of every function')
+    parser.add_argument('--mix', type=parse_mix, default=MIX, metavar='KIND=WEIGHT,...',
+                        help=f'weights of the statements ({",".join(f"{k}={v}" for k, v in MIX.items())})')
+    parser.add_argument('--other', type=int, default=2, help='chunks of other types before every \'scr_\' chunk')
+    parser.add_argument('--vocabulary', type=int, default=1000,
+                        help='number of different string constants of all functions')
+    parser.add_argument('--templates', type=int, default=0,
+                        help='nested functions are copies of this many different functions per depth (0: all differ)')
+    parser.add_argument('--seed', type=int, default=1)
+
+    if len(sys.argv) < 2:
+        parser.print_help()
+        exit(1)
+
+    args = parser.parse_args()
+
+    data, instructions = generate(Settings(
+        args.scripts, args.instructions, args.depth, args.functions, args.blocks, args.strings, args.numbers,
+        args.mix, args.other, args.vocabulary, args.templates, args.seed))
+
+    Path(args.file).write_bytes(data)
+    print(f'{args.file}: {args.scripts} scripts, {instructions} instructions, {len(data) / 1e6:.2f} MB')
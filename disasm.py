@@ -0,0 +1,142 @@
+import sys
+import json
+import argparse
+from pathlib import Path
+
+import chunkfile
+from shared import Chunk, functions
+from lua4 import OP, OP_NAME, STRING_OPS, NUMBER_OPS, decode
+
+# Arguments shown for each opcode: unsigned U, signed S, A and B, or none
+U_OPS = {
+    OP.RETURN, OP.PUSHNIL, OP.POP, OP.PUSHSTRING, OP.PUSHNUM, OP.PUSHNEGNUM, OP.PUSHUPVALUE, OP.GETLOCAL, OP.GETGLOBAL,
+    OP.GETDOTTED, OP.GETINDEXED, OP.PUSHSELF, OP.CREATETABLE, OP.SETLOCAL, OP.SETGLOBAL, OP.SETMAP, OP.CONCAT
+}
+S_OPS = {
+    OP.PUSHINT, OP.ADDI, OP.JMPNE, OP.JMPEQ, OP.JMPLT, OP.JMPLE, OP.JMPGT, OP.JMPGE, OP.JMPT, OP.JMPF, OP.JMPONT,
+    OP.JMPONF, OP.JMP, OP.FORPREP, OP.FORLOOP, OP.LFORPREP, OP.LFORLOOP
+}
+AB_OPS = {OP.CALL, OP.TAILCALL, OP.SETTABLE, OP.SETLIST, OP.CLOSURE}
+
+# Jump targets relative to the pc, see cfg.jump_target. S is one less than the stored offset
+JUMP_OFFSETS = {op: 2 for op in S_OPS - {OP.PUSHINT, OP.ADDI, OP.FORPREP, OP.LFORPREP}}
+JUMP_OFFSETS.update({OP.FORPREP: 3, OP.LFORPREP: 3})
+
+NAMES = [f'{x:<12}' for x in OP_NAME]
+
+
+def target(instruction) -> int:
+    offset = JUMP_OFFSETS.get(instruction.op)
+    return None if offset is None else instruction.pc + instruction.s + offset
+
+
+def header(path: str, chunk: Chunk) -> str:
+    return f'function {path or "main"} {chunk.name!r} ({chunk.parameters}{", ..." if chunk.variadic else ""}) ' \
+           f'line {chunk.line}, {len(chunk.strings)} strings, {len(chunk.numbers)} numbers, ' \
+           f'{len(chunk.functions)} functions, {len(chunk.instructions)} instructions'
+
+
+def listing(path: str, chunk: Chunk) -> str:
+    quoted = [json.dumps(x, ensure_ascii=False) for x in chunk.strings]
+    prefix = f'{path}.' if path else ''
+    lines = [header(path, chunk)]
+
+    for instruction in decode(chunk):
+        pc, op, a, b, s, u = instruction.pc, instruction.op, instruction.a, instruction.b, instruction.s, instruction.u
+        jump = target(instruction)
+        if op in U_OPS:
+            args = f'{u}'
+        elif op in S_OPS:
+            args = f'{s + 1}'
+        elif op in AB_OPS:
+            args = f'{a} {b}'
+        else:
+            args = ''
+
+        if jump is not None:
+            comment = f'  ; -> {jump}'
+        elif op in STRING_OPS:
+            comment = f'  ; {quoted[u]}' if u < len(quoted) else '  ; ?'
+        elif op in NUMBER_OPS:
+            sign = '-' if op == OP.PUSHNEGNUM else ''
+            comment = f'  ; {sign}{chunk.numbers[u]}' if u < len(chunk.numbers) else '  ; ?'
+        elif op == OP.CLOSURE:
+            comment = f'  ; function {prefix}{a}'
+        else:
+            comment = ''
+
+        if comment:
+            lines.append(f'{pc:>6}  {NAMES[op]} {args:<10}{comment}')
+        else:
+            lines.append(f'{pc:>6}  {NAMES[op]} {args}'.rstrip())
+
+    lines.append('\n')
+    return '\n'.join(lines)
+
+
+def columns(path: str, chunk: Chunk) -> str:
+    # One JSON object per function, every instruction field is a list
+    decoded = decode(chunk)
+    return json.dumps({
+        'path': path,
+        'name': chunk.name,
+        'line': chunk.line,
+        'parameters': chunk.parameters,
+        'variadic': chunk.variadic,
+        'functions': len(chunk.functions),
+        'op': [OP_NAME[x.op] for x in decoded],
+        'a': [x.a for x in decoded],
+        'b': [x.b for x in decoded],
+        'u': [x.u for x in decoded],
+        's': [x.s + 1 for x in decoded],
+        'target': [target(x) for x in decoded],
+        # The string or number constant of every instruction, None if it has none
+        'constant': [x.value for x in decoded],
+    }, ensure_ascii=False) + '\n'
+
+
+FORMATS = {'text': (listing, '.lst'), 'json': (columns, '.jsonl')}
+
+
+def disassemble(chunk: Chunk, out, format: str = 'text'):
+    write = FORMATS[format][0]
+    for path, function in functions(chunk):
+        out.write(write(path, function))
+
+
+def main(file: Path, out, format: str = 'text'):
+    with open(file, 'rb') as f:
+        chunk = chunkfile.load(f)
+
+    disassemble(chunk, out, format)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Disassembles all functions of \'*.dat\' files, with resolved constants and jump targets. '
+                    'Every file gets a \'*.lst\' (text) or \'*.jsonl\' (json) file next to it.')
+    parser.add_argument('files', nargs='+', help='\'*.dat\' files')
+    parser.add_argument('--format', choices=FORMATS, default='text',
+                        help='text: one line per instruction, json: one object per function with a list per field')
+    parser.add_argument('--output', '-o', metavar='FILE', help='write all files to FILE instead, \'-\' for stdout')
+
+    if len(sys.argv) < 2:
+        parser.print_help()
+        exit(1)
+
+    args = parser.parse_args()
+    files = [Path(x) for x in args.files]
+
+    if args.output:
+        out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', buffering=1 << 20)
+        for file in files:
+            main(file, out, args.format)
+        if out is not sys.stdout:
+            out.close()
+
+    else:
+        for file in files:
+            name = file.with_suffix(FORMATS[args.format][1])
+            with open(name, 'w', encoding='utf-8', buffering=1 << 20) as out:
+                main(file, out, args.format)
+            print(name)
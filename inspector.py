@@ -1,12 +1,18 @@
 import sys
-import pickle
-from shared import Chunk
+import chunkfile
 
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        print('Pass one or more \'*.dat\' files as arguments.\n\n')
+        print('Pass one or more \'*.dat\' files as arguments.\n\n'
+              'An optional function path selects a nested function (0.2 is the third function of the first function).')
         exit(1)
 
-    chunk = pickle.load(open(sys.argv[1], 'rb'))
-    print(chunk)
+    # The file is mapped, only the selected function and its counts are decoded
+    chunk = chunkfile.load_mapped(sys.argv[1], lazy=True)
+
+    if len(sys.argv) > 2:
+        for index in sys.argv[2].split('.'):
+            chunk = chunk.functions[int(index)]
+
+    print(chunk.summary(), end='')
@@ -30,7 +30,47 @@ class Iterator:
     def prev(self):
         self._pos -= 1
 
-        self._pos = max(self._min, self._pos)
+        self._pos = max(self._min + 1, self._pos)
 
-        self._val = self._values[self._pos]
+        self._val = self._values[self._pos - 1]
         return self._val
+
+
+# Position in a list of instructions, the position can be moved to any instruction in O(1)
+# Reading beyond either end returns None instead of raising
+class Cursor:
+    __slots__ = ('code', 'pc', 'end')
+
+    def __init__(self, code: list, pc: int = 0):
+        self.code = code
+        self.pc = pc
+        self.end = len(code)
+
+    def __bool__(self):
+        return self.pc < self.end
+
+    def get(self):
+        if 0 <= self.pc < self.end:
+            return self.code[self.pc]
+        return None
+
+    def next(self):
+        self.pc += 1
+        return self.get()
+
+    def prev(self):
+        self.pc -= 1
+        return self.get()
+
+    def seek(self, pc: int):
+        self.pc = pc
+        return self.get()
+
+    def peek(self, k: int = 1):
+        pc = self.pc + k
+        if 0 <= pc < self.end:
+            return self.code[pc]
+        return None
+
+    def slice(self, start: int, end: int) -> list:
+        return self.code[max(start, 0):min(end, self.end)]
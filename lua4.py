@@ -1,3 +1,8 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 INT_MAX = 2147483647 - 2
 NL = '\n'
 
@@ -26,6 +31,82 @@ def get_Bx(instruction: int) -> int:
     return (instruction & 0xFFFFFFC0) >> (6 + 9)
 
 
+# Instruction fields of a whole instruction list, one list per field
+class Fields:
+    def __init__(self, op: list, a: list, b: list, bx: list, s: list, u: list):
+        self.op = op
+        self.a = a
+        self.b = b
+        self.bx = bx
+        self.s = s
+        self.u = u
+
+    def __len__(self):
+        return len(self.op)
+
+
+def get_fields(instructions) -> Fields:
+    # Same masks and shifts as the get_* functions above, applied to all instructions at once
+    if numpy is not None:
+        i = numpy.asarray(instructions, dtype=numpy.int64)
+        u = (i & 0xFFFFFFC0) >> 6
+        return Fields(
+            (i & 0x0000003F).tolist(),
+            ((i & 0xFFFF8000) >> 15).tolist(),
+            ((i & 0x00007FC0) >> 6).tolist(),
+            ((i & 0xFFFFFFC0) >> (6 + 9)).tolist(),
+            (((i & 0xFFFFFFC0) - INT_MAX) >> 6).tolist(),
+            u.tolist())
+
+    return Fields(
+        [i & 0x0000003F for i in instructions],
+        [(i & 0xFFFF8000) >> 15 for i in instructions],
+        [(i & 0x00007FC0) >> 6 for i in instructions],
+        [(i & 0xFFFFFFC0) >> (6 + 9) for i in instructions],
+        [((i & 0xFFFFFFC0) - INT_MAX) >> 6 for i in instructions],
+        [(i & 0xFFFFFFC0) >> 6 for i in instructions])
+
+
+# Decoded instruction with its resolved string or number constant
+class Instruction:
+    __slots__ = ('pc', 'op', 'a', 'b', 'bx', 's', 'u', 'value')
+
+    def __init__(self, pc: int, op: int, a: int, b: int, bx: int, s: int, u: int, value=None):
+        self.pc = pc
+        self.op = op
+        self.a = a
+        self.b = b
+        self.bx = bx
+        self.s = s
+        self.u = u
+        self.value = value
+
+
+def decode(chunk) -> list:
+    # The decoded table is built once per chunk and shared by every pass over its bytecode
+    decoded = getattr(chunk, 'decoded', None)
+    if decoded is not None:
+        return decoded
+
+    fields = get_fields(chunk.instructions)
+    strings = chunk.strings
+    numbers = chunk.numbers
+
+    decoded = []
+    for pc, (op, a, b, bx, s, u) in enumerate(zip(fields.op, fields.a, fields.b, fields.bx, fields.s, fields.u)):
+        # The constant index is U, B only holds its lower 9 bits
+        value = None
+        if op in STRING_OPS and u < len(strings):
+            value = strings[u]
+        elif op in NUMBER_OPS and u < len(numbers):
+            value = numbers[u]
+
+        decoded.append(Instruction(pc, op, a, b, bx, s, u, value))
+
+    chunk.decoded = decoded
+    return decoded
+
+
 OP_NAME = [
     "END",  # 0b000000, 0
     "RETURN",  # 0b000001, 1
@@ -102,7 +183,18 @@ class OP:
     JMPF, JMPONT, JMPONF, JMP, PUSHNILJMP, FORPREP, FORLOOP, LFORPREP, LFORLOOP, CLOSURE = range(49)
 
 
+# Operators whose B argument indexes the string or the number constants
+STRING_OPS = {OP.PUSHSTRING, OP.GETGLOBAL, OP.GETDOTTED, OP.PUSHSELF, OP.SETGLOBAL}
+NUMBER_OPS = {OP.PUSHNUM, OP.PUSHNEGNUM}
+
+
+# Nodes keep their children and render them only when written. Statements emit indented lines, expressions are
+# printed without indentation and use the level only for the blocks of nested functions
+
+
 class ASTPrimitive:
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -110,7 +202,99 @@ class ASTPrimitive:
         return str(self.value)
 
 
+# Expression built from a format, its child expressions and the decoded operand of the instruction
+class ASTExpression:
+    __slots__ = ('template', 'values', 'operand')
+
+    def __init__(self, template: str, values: list, operand=None):
+        self.template = template
+        self.values = values
+        self.operand = operand
+
+    def print(self, level: int = 0):
+        return self.template.format(*[x.print(level) for x in self.values], operand=self.operand)
+
+
+# Reserved words of Lua 4.0, they cannot be written as names
+KEYWORDS = {
+    'and', 'break', 'do', 'else', 'elseif', 'end', 'for', 'function', 'if', 'in', 'local', 'nil', 'not', 'or',
+    'repeat', 'return', 'then', 'until', 'while'
+}
+
+
+def identifier(name: str) -> bool:
+    # Lua names are ASCII letters, digits and '_', not starting with a digit
+    return name.isascii() and name.isidentifier() and name not in KEYWORDS
+
+
+def quote(value: str) -> str:
+    # A string constant as a Lua string literal, a line break in it would end the line of the statement
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r') + '"'
+
+
+def field(table: str, key: str) -> str:
+    # t["x"] is written as t.x
+    name = key[1:-1]
+    if key[:1] == '"' and key[-1:] == '"' and identifier(name):
+        return f'{table}.{name}'
+    return f'{table}[{key}]'
+
+
+def is_name(node) -> bool:
+    # Whether the node is written as a name like a.b.c, which 'function a.b.c()' can define
+    if isinstance(node, ASTPrimitive):
+        return isinstance(node.value, str) and identifier(node.value)
+    if isinstance(node, ASTIndex):
+        key = node.key
+        return isinstance(key, ASTPrimitive) and isinstance(key.value, str) and key.value[:1] == '"' and \
+            key.value[-1:] == '"' and identifier(key.value[1:-1]) and is_name(node.table)
+    if isinstance(node, ASTExpression):
+        return node.template == '{0}.{operand}' and identifier(str(node.operand)) and is_name(node.values[0])
+    return False
+
+
+class ASTIndex:
+    __slots__ = ('table', 'key')
+
+    def __init__(self, table, key):
+        self.table = table
+        self.key = key
+
+    def print(self, level: int = 0):
+        return field(self.table.print(level), self.key.print(level))
+
+
+INDENTS = ['']
+
+
+def indent(level: int) -> str:
+    while len(INDENTS) <= level:
+        INDENTS.append(INDENTS[-1] + ASTRoot.INDENT)
+    return INDENTS[level]
+
+
+# Writes the lines of the statements to a file-like sink, or appends them to a list
+class Emitter:
+    def __init__(self, sink):
+        self.write = sink.append if isinstance(sink, list) else sink.write
+
+    def line(self, level: int, text: str):
+        self.write(indent(level) + text + NL)
+
+    def block(self, statements: list, level: int):
+        for statement in statements:
+            statement.emit(self, level)
+
+
+def render(node, level: int = 0) -> str:
+    buffer = []
+    node.emit(Emitter(buffer), level)
+    return ''.join(buffer)
+
+
 class ASTRoot:
+    __slots__ = ('statements',)
+
     INDENT = '  '
 
     def __init__(self, statements: iter = None):
@@ -123,95 +307,197 @@ class ASTRoot:
         self.statements.append(other)
         return self
 
+    def emit(self, emitter: Emitter, level: int = 0):
+        emitter.block(self.statements, level)
+
     def print(self, level: int = 0):
-        children = ''
-        for child in self.statements:
-            children += child.print(level) + '\n'
+        return render(self, level)
+
+
+# Statements that were decompiled and rendered at level 0 before
+class ASTText:
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def emit(self, emitter: Emitter, level: int = 0):
+        # Only '\n' ends a line, str.splitlines would also split at characters like '\x85' in string constants
+        lines = self.text.split('\n')
+        if not lines[-1]:
+            lines.pop()
 
-        return children
+        for line in lines:
+            if line:
+                emitter.line(level, line)
+            else:
+                emitter.write(NL)
 
 
 class ASTClosure:
+    __slots__ = ('name', 'parameters', 'body')
+
     def __init__(self, name: str, parameters: [str], body: ASTRoot = None):
         self.name = name
         self.parameters = parameters
         self.body = body
 
-    def print(self, level: int = 0):
-        indent = ASTRoot.INDENT * level
+    def header(self) -> str:
+        return f'function {self.name}({",".join(self.parameters)})'
+
+    def emit(self, emitter: Emitter, level: int):
+        # A function with a name is a statement, it is followed by an empty line
+        emitter.line(level, self.header())
+        self.body.emit(emitter, level + 1)
+        emitter.line(level, 'end')
+        emitter.write(NL)
 
-        return str(
-            f'{indent}function {self.name}({",".join(self.parameters)})\n'
-            f'{self.body.print(level + 1)}'
-            f'{indent}end\n')
+    def print(self, level: int = 0):
+        # Without a name it is the value of an expression
+        return f'{self.header()}{NL}{render(self.body, level + 1)}{indent(level)}end'
 
 
 class ASTCall:
-    def __init__(self, name: str, args: [ASTPrimitive] = None):
-        self.name = name
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, args: list = None):
+        self.function = function
 
         if not args:
             self.args = []
         else:
             self.args = args
 
+    def emit(self, emitter: Emitter, level: int):
+        emitter.line(level, self.print(level))
+
     def print(self, level: int = 0):
-        indent = ASTRoot.INDENT * level
-        return f'{indent}{self.name}({", ".join(list(map(lambda x: x.print(level), self.args)))})'
+        return f'{self.function.print(level)}({", ".join(x.print(level) for x in self.args)})'
 
 
 class ASTAssignment:
-    def __init__(self, left: ASTPrimitive, right: ASTPrimitive):
-        self.left = left.print()
-        self.right = right.print()
+    __slots__ = ('left', 'right')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
 
-    def print(self, level: int):
-        indent = ASTRoot.INDENT * level
-        return f'{indent}{self.left} = {self.right}'
+    def emit(self, emitter: Emitter, level: int):
+        emitter.line(level, f'{self.left.print(level)} = {self.right.print(level)}')
 
 
 class ASTCondition:
-    def __init__(self, condition: str, block: [ASTPrimitive]):
+    __slots__ = ('condition', 'block', 'else_block')
+
+    def __init__(self, condition, block: list, else_block: list = None):
         self.condition = condition
         self.block = block
+        self.else_block = else_block
 
-    def print(self, level: int):
-        indent = ASTRoot.INDENT * level
-        subindent = ASTRoot.INDENT * (level + 1)
-        return str(
-            f'{indent}if {self.condition} then\n{subindent}'
-            f'{(NL + subindent).join(list(map(lambda x: x.print(level), self.block)))}'
-            f'\n{indent}end')
+    def emit(self, emitter: Emitter, level: int):
+        emitter.line(level, f'if {self.condition.print(level)} then')
+        emitter.block(self.block, level + 1)
+        if self.else_block:
+            emitter.line(level, 'else')
+            emitter.block(self.else_block, level + 1)
+        emitter.line(level, 'end')
 
 
-class ASTTable:
-    def __init__(self, variable: str, values: [ASTPrimitive]):
+class ASTWhile:
+    __slots__ = ('condition', 'block')
+
+    def __init__(self, condition, block: list):
+        self.condition = condition
+        self.block = block
+
+    def emit(self, emitter: Emitter, level: int):
+        emitter.line(level, f'while {self.condition.print(level)} do')
+        emitter.block(self.block, level + 1)
+        emitter.line(level, 'end')
+
+
+class ASTRepeat:
+    __slots__ = ('block', 'condition')
+
+    def __init__(self, block: list, condition):
+        self.block = block
+        self.condition = condition
+
+    def emit(self, emitter: Emitter, level: int):
+        emitter.line(level, 'repeat')
+        emitter.block(self.block, level + 1)
+        emitter.line(level, f'until {self.condition.print(level)}')
+
+
+class ASTFor:
+    __slots__ = ('variable', 'start', 'limit', 'step', 'block')
+
+    def __init__(self, variable: str, start, limit, step, block: list):
         self.variable = variable
-        self.values = values
+        self.start = start
+        self.limit = limit
+        self.step = step
+        self.block = block
 
-    def print(self, level: int = 0):
-        indent = ASTRoot.INDENT * level
-        subindent = ASTRoot.INDENT * (level + 1)
-        return str(
-            f'{indent}{self.variable} = {{\n{subindent}'
-            f'{("," + NL + subindent).join(list(map(lambda x: x.print(level), self.values)))}'
-            f'\n{indent}}}\n')
+    def emit(self, emitter: Emitter, level: int):
+        step = self.step.print(level)
+        step = f', {step}' if step != '1' else ''
+        emitter.line(level, f'for {self.variable} = {self.start.print(level)}, {self.limit.print(level)}{step} do')
+        emitter.block(self.block, level + 1)
+        emitter.line(level, 'end')
 
 
-class ASTMap:
-    def __init__(self, name: str, values: [ASTPrimitive]):
-        self.name = name
-        self.values = values
+class ASTForIn:
+    __slots__ = ('key', 'value', 'table', 'block')
 
-    def print(self, level: int = 0):
-        return '#map#'
+    def __init__(self, key: str, value: str, table, block: list):
+        self.key = key
+        self.value = value
+        self.table = table
+        self.block = block
+
+    def emit(self, emitter: Emitter, level: int):
+        emitter.line(level, f'for {self.key}, {self.value} in {self.table.print(level)} do')
+        emitter.block(self.block, level + 1)
+        emitter.line(level, 'end')
 
 
-class ASTArithmeticOperator:
-    def __init__(self, left, right, operator: str):
-        self.left = left.print()
-        self.right = right.print()
-        self.op = operator
+class ASTBreak:
+    __slots__ = ()
+
+    def emit(self, emitter: Emitter, level: int):
+        emitter.line(level, 'break')
+
+
+class ASTTable:
+    __slots__ = ('values', 'fields')
+
+    def __init__(self, values: list = None, fields: list = None):
+        self.values = values if values else []
+        self.fields = fields if fields else []  # (key, value) pairs
 
     def print(self, level: int = 0):
-        return f'{self.left} {self.op} {self.right}'
+        # Lua 4.0 separates the list part and the record part of a constructor with ';'
+        parts = []
+        if self.values:
+            parts.append(', '.join(x.print(level) for x in self.values))
+        if self.fields:
+            parts.append(', '.join(
+                f'{field("", key.print(level)).lstrip(".")} = {value.print(level)}' for key, value in self.fields))
+        return f'{{{"; ".join(parts)}}}'
+
+
+class ASTReturn:
+    __slots__ = ('values',)
+
+    def __init__(self, values: list = None):
+        if not values:
+            self.values = []
+        else:
+            self.values = values
+
+    def emit(self, emitter: Emitter, level: int):
+        if not self.values:
+            emitter.line(level, 'return')
+        else:
+            emitter.line(level, f'return {", ".join(x.print(level) for x in self.values)}')
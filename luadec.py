@@ -1,360 +1,907 @@
+import io
 import sys
-import pickle
+import time
+import argparse
+import cProfile
+import contextlib
+import multiprocessing
+from multiprocessing.connection import wait
 from pathlib import Path
 
-from shared import Chunk
-from iter import Iterator
-from lua4 import OP, OP_NAME, get_OP, get_B, get_Bx, get_S, get_U, get_A
-from lua4 import ASTRoot, ASTClosure, ASTCall, \
-    ASTAssignment, ASTPrimitive, ASTTable, ASTMap, ASTCondition
+import tracing
+import cache
+import disasm
+import chunkfile
+import profiling
+from shared import Chunk, count_instructions, functions
+from iter import Cursor
+from cfg import CFG, Block, jump_target
+from lua4 import OP, OP_NAME, Instruction, Emitter, decode, render, is_name, quote
+from lua4 import ASTRoot, ASTText, ASTClosure, ASTCall, ASTReturn, ASTAssignment, ASTPrimitive, ASTExpression, ASTIndex, \
+    ASTTable, ASTCondition, ASTWhile, ASTRepeat, ASTFor, ASTForIn, ASTBreak
+
+
+# Part of the cache keys, change it when the decompiled output changes
+VERSION = 5
+
+# Nested functions with fewer instructions are decompiled again instead of being looked up in the cache
+MIN_CACHED_INSTRUCTIONS = 64
+
+# Cache of decompiled scripts and nested function bodies, see configure_cache
+scripts = None
+
+# Decompiled bodies of nested functions by their hash and upvalue names. Equal functions of the same or of other
+# scripts are decompiled once, the oldest bodies are dropped above the limit
+bodies = {}
+MAX_BODIES = 4096
+
+
+def configure_cache(folder, max_size: int):
+    global scripts
+    scripts = cache.Cache(folder, max_size) if folder else None
 
 
 class State:
-    def __init__(self):
+    def __init__(self, cfg: CFG, upvalues: [str] = None):
         self.parameters = []
         self.locals = []
         self.stack = []
+        self.upvalues = upvalues if upvalues else []
+        self.pending = []  # Local declarations that are emitted before the next statement
+        self.leaves = {}
+        self.cfg = cfg
+        self.ends = []  # End pc of the enclosing blocks, innermost last
+        self.exits = []  # Exit pc of the enclosing loops, innermost last
+        self.headers = set()  # Start pc of the loops that are being processed
+
+    def pop(self, n: int) -> list:
+        # The top n values of the stack, the deepest first
+        if n > len(self.stack):
+            raise IndexError(f'pop of {n} values from a stack of {len(self.stack)}')
+        if n == 0:
+            return []
+
+        values = self.stack[-n:]
+        del self.stack[-n:]
+        return values
+
+    def depth(self, slot: int) -> int:
+        # Number of stack values from the Lua stack slot upwards, the whole stack if the slot is not on it
+        index = slot - len(self.locals)
+        if 0 <= index <= len(self.stack):
+            return len(self.stack) - index
+        return len(self.stack)
+
+    def declare(self, n: int):
+        # Values left at the bottom of the stack are the initial values of locals
+        for value in self.stack[:n]:
+            name = f'l{len(self.locals)}'
+            self.locals.append(name)
+            self.pending.append(ASTAssignment(ASTPrimitive(f'local {name}'), value))
+        del self.stack[:n]
+
+    def local(self, index: int) -> str:
+        # Create local variable names (SWBF does not store local variable names)
+        while len(self.locals) <= index:
+            if self.stack:
+                self.declare(1)
+            else:
+                self.locals.append(f'l{len(self.locals)}')
 
+        return self.locals[index]
 
-def process_closure(it: Iterator, chunk: Chunk, state: State):
-    name = ''
 
-    instruction = it.next()
-    operator = get_OP(instruction)
+# Marks the table argument that PUSHSELF passes to a method call
+SELF = ASTPrimitive('self')
 
-    if operator == OP.SETGLOBAL:
-        name = chunk.strings[get_B(instruction)]
-        it.next()
-    else:
-        it.prev()
 
-    print(chunk.functions[get_Bx(it.get())].instructions)
-    body = process_chunk(chunk.functions[get_Bx(it.get())])
+def process_nothing(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    return None
 
-    return ASTClosure(name, state.parameters, body)
 
+def call(instruction: Instruction, state: State) -> ASTCall:
+    # CALL/TAILCALL A B: the function in stack slot A is called with the values above it
+    values = state.pop(state.depth(instruction.a))
+    function = values.pop(0) if values else ASTPrimitive('')
 
-def process_call(it: Iterator, chunk: Chunk, state: State):
-    args = []
-    while state.stack:
-        args.append(state.stack.pop())
+    if values and values[0] is SELF:
+        del values[0]
 
-    if args:
-        name = args.pop()
-    else:
-        name = ASTPrimitive('')
+    return ASTCall(function, values)
 
-    return ASTCall(
-        name.value,
-        reversed(args))
 
+def process_call(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    # B is the number of results, a call without results is a statement
+    result = call(instruction, state)
 
-def process_assignment(it: Iterator, chunk: Chunk, state: State):
-    return ASTAssignment(
-        ASTPrimitive('var'),
-        ASTPrimitive(0))
+    if instruction.b == 0:
+        return result
 
+    state.stack.append(result)
+    return None
 
-def process_set_table(it: Iterator, chunk: Chunk, state: State):
-    right = state.stack.pop()
-    left = state.stack.pop()
 
-    return ASTAssignment(
-        left,
-        right)
+def process_tail_call(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    return ASTReturn([call(instruction, state)])
 
 
-def process_create_table(it: Iterator, chunk: Chunk, state: State):
-    num_entries = get_B(it.get())
-    it.next()
+def process_return(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    # RETURN U: returns the values from stack slot U upwards
+    return ASTReturn(state.pop(state.depth(instruction.u)))
 
-    entries = []
 
-    name = state.stack.pop()
+def process_push_nil(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    state.stack.extend(ASTPrimitive('nil') for _ in range(instruction.u))
+    return None
 
-    for _ in range(num_entries):
-        build_stack(it, chunk, state)
-        it.next()
 
-        operator = get_OP(it.get())
-        if operator in PROCESS:
-            state.stack.append(PROCESS[operator](it, chunk, state))
-        else:
-            build_stack(it, chunk, state)
-        it.next()
+def process_pop(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    # POP U: removes the locals of a block that ends. Values still on the stack are locals that were never used,
+    # they are declared first so that their side effects are kept
+    state.declare(len(state.stack))
+    del state.locals[max(0, len(state.locals) - instruction.u):]
+    return None
+
+
+def process_push_self(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    table = state.stack.pop()
+    state.stack.append(ASTExpression('{0}:{operand}', [table], instruction.value))
+    state.stack.append(SELF)
+    return None
+
+
+def process_get_table(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    table, key = state.pop(2)
+    state.stack.append(ASTIndex(table, key))
+    return None
+
+
+def process_concat(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    # CONCAT U: concatenates the top U values
+    values = state.pop(instruction.u)
+    state.stack.append(ASTExpression(f'({" .. ".join(f"{{{i}}}" for i in range(len(values)))})', values))
+    return None
+
+
+def process_closure(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    # CLOSURE A B: function A, closed over the top B values
+    function = chunk.functions[instruction.a]
+    upvalues = [x.print() for x in state.pop(instruction.b)]
+
+    identity = (cache.chunk_hash(function), *upvalues)
+    body = bodies.get(identity)
+
+    # Bodies of larger functions are shared through the cache, by content and upvalue names
+    key = None
+    if body is None and scripts is not None and len(function.instructions) >= MIN_CACHED_INSTRUCTIONS:
+        key = cache.key(cache.chunk_hash(function), VERSION, *upvalues)
+        text = scripts.get(key)
+        if text is not None:
+            body = ASTText(text)
+
+    if body is None:
+        if tracing.enabled(tracing.TRACE):
+            tracing.log(tracing.TRACE, list(function.instructions))
+        body = process_chunk(function, upvalues)
+
+        if key is not None:
+            text = render(body)
+            scripts.put(key, text)
+            body = ASTText(text)
+
+    if identity not in bodies:
+        if len(bodies) >= MAX_BODIES:
+            del bodies[next(iter(bodies))]
+        bodies[identity] = body
+
+    parameters = [f'p{x}' for x in range(function.parameters)]
+    if function.variadic:
+        parameters.append('...')
+
+    state.stack.append(ASTClosure('', parameters, body))
+    return None
+
+
+def process_create_table(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    state.stack.append(ASTTable())
+    return None
+
+
+def process_set_list(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    # SETLIST A B: appends the top B values to the table below them
+    values = state.pop(instruction.b)
+    state.stack[-1].values.extend(values)
+    return None
+
+
+def process_set_map(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    # SETMAP U: adds the top U key and value pairs to the table below them
+    values = state.pop(2 * instruction.u)
+    state.stack[-1].fields.extend(zip(values[::2], values[1::2]))
+    return None
+
+
+def assignment(target, value):
+    if isinstance(value, ASTClosure) and not value.name:
+        value.name = target.print()
+        return value
+    return ASTAssignment(target, value)
+
 
+def process_set_local(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    value = state.stack.pop()
+    return ASTAssignment(ASTPrimitive(state.local(instruction.u)), value)
+
+
+def process_set_global(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    return assignment(ASTPrimitive(instruction.value), state.stack.pop())
+
+
+def process_set_table(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    # SETTABLE A B: t[i] = v with the table A values below the top, pops B values
+    value = state.stack[-1]
+    table = state.stack[-instruction.a]
+    key = state.stack[-instruction.a + 1]
+    state.pop(instruction.b)
+
+    target = ASTIndex(table, key)
+    if not is_name(target):
+        return ASTAssignment(target, value)
+    return assignment(target, value)
+
+
+# Condition under which a jump is taken, and the condition of the block the jump skips
+COMPARISONS = {OP.JMPNE: '~=', OP.JMPEQ: '==', OP.JMPLT: '<', OP.JMPLE: '<=', OP.JMPGT: '>', OP.JMPGE: '>='}
+NEGATED_COMPARISONS = {OP.JMPNE: '==', OP.JMPEQ: '~=', OP.JMPLT: '>=', OP.JMPLE: '>', OP.JMPGT: '<=', OP.JMPGE: '<'}
+TESTS = {OP.JMPT, OP.JMPF}
+
+
+def jump_conditions(instruction: Instruction, state: State) -> tuple:
+    # The condition under which the jump is taken and the one under which it is not
+    operator = instruction.op
+
+    if operator in TESTS:
         value = state.stack.pop()
-        key = state.stack.pop()
-        entries.append(ASTAssignment(key, value))
+        negated = ASTExpression('not {0}', [value])
+        return (value, negated) if operator == OP.JMPT else (negated, value)
 
-    return ASTTable(
-        name.value,
-        entries)
+    values = state.pop(2)
+    return ASTExpression(f'{{0}} {COMPARISONS[operator]} {{1}}', values), \
+        ASTExpression(f'{{0}} {NEGATED_COMPARISONS[operator]} {{1}}', values)
 
 
-def process_map(it: Iterator, chunk: Chunk, state: State):
-    return ASTMap(
-        'map',
-        [ASTPrimitive(0)])
+def jump_condition(instruction: Instruction, state: State, negate: bool):
+    return jump_conditions(instruction, state)[negate]
 
 
-def process_condition(it: Iterator, chunk: Chunk, state: State):
-    operator = get_OP(it.get())
+def forward_target(instruction: Instruction, code: list) -> int:
+    # Backward jumps are only taken by loops, those are handled by process_loop and process_for
+    target = jump_target(instruction)
+    if not instruction.pc < target <= len(code):
+        raise ValueError(f'{OP_NAME[instruction.op]} at {instruction.pc} jumps to {target}')
+    return target
 
-    if operator == OP.JMPT:
-        condition = f'{state.stack.pop().print()} ~= nil'
 
-    elif operator == OP.JMPF:
-        condition = f'{state.stack.pop().print()} == nil'
+def branches(instruction: Instruction, state: State, end: int) -> list:
+    # The conditional jumps from instruction on with only operands between them, (pc, target) of each
+    code = state.cfg.code
+    loops = state.cfg.loops
+    exits = state.exits[-1:]
+    result = [(instruction.pc, forward_target(instruction, code))]
+    start = pc = instruction.pc + 1
 
-    elif operator == OP.JMPNE:
-        right = state.stack.pop()
-        left = state.stack.pop()
-        condition = f'{left.print()} ~= {right.print()}'
+    while pc < end and pc not in loops:
+        current = code[pc]
 
-    elif operator == OP.JMPEQ:
-        right = state.stack.pop()
-        left = state.stack.pop()
-        condition = f'{left.print()} == {right.print()}'
+        if current.op in CONDITIONS and pc + 1 < len(code) and code[pc + 1].op == OP.PUSHNILJMP:
+            pc += 3  # Comparison used as a value
+            continue
 
-    elif operator == OP.JMPLT:
-        right = state.stack.pop()
-        left = state.stack.pop()
-        condition = f'{left.print()} < {right.print()}'
+        if current.op in CONDITIONS and pc > start:
+            target = jump_target(current)
+            if not (pc < target <= end or target in exits):
+                break
+            result.append((pc, target))
+            start = pc + 1
+
+        elif current.op not in OPERANDS and not (current.op == OP.CALL and current.b):
+            break
+
+        pc += 1
+
+    return result
+
+
+def merge_branches(found: list) -> tuple:
+    # Merges neighbouring jumps of 'a or b' and 'a and b' until the first one covers the whole condition. Items are
+    # (last branch, target, tree), trees are branch indexes or (operator, left tree, right tree) of the condition
+    # under which the jump is taken
+    items = [(i, target, i) for i, (pc, target) in enumerate(found)]
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(items) - 1):
+            middle, target, left = items[i]
+            last, next_target, right = items[i + 1]
+            inside = range(found[middle][0] + 1, found[last][0] + 1)
+
+            # Only the first jump may lead into the operands of the second
+            if any(x[1] in inside for x in items[:i] + items[i + 2:]):
+                continue
+
+            if target == next_target:
+                operator = 'or'  # Both jump to the same target
+            elif target == found[last][0] + 1:
+                operator = 'and'  # The first jumps over the second
+            else:
+                continue
 
-    elif operator == OP.JMPLE:
-        right = state.stack.pop()
-        left = state.stack.pop()
-        condition = f'{left.print()} <= {right.print()}'
+            items[i:i + 2] = [(last, next_target, (operator, left, right))]
+            merged = True
+            break
 
-    elif operator == OP.JMPGT:
-        right = state.stack.pop()
-        left = state.stack.pop()
-        condition = f'{left.print()} > {right.print()}'
+    return items[0]
 
-    elif operator == OP.JMPGE:
-        right = state.stack.pop()
-        left = state.stack.pop()
-        condition = f'{left.print()} >= {right.print()}'
 
-    # elif operator == OP.JMPONT:
-    #    value = f'\n'
+def either(left, right):
+    return ASTExpression('({0} or {1})', [left, right])
 
-    # elif operator == OP.JMPONF:
-    #    value = f'\n'
 
-    # elif operator == OP.JMP:
-    #    value = f'\n'
+def both(left, right):
+    return ASTExpression('({0} and {1})', [left, right])
 
+
+def compound(tree, conditions: list) -> tuple:
+    # The conditions under which the merged jump is taken and under which it is not
+    if isinstance(tree, int):
+        return conditions[tree]
+
+    operator, left, right = tree
+    (left_taken, left_skipped), (right_taken, right_skipped) = compound(left, conditions), compound(right, conditions)
+    if operator == 'or':
+        return either(left_taken, right_taken), both(left_skipped, right_skipped)
+    return both(left_skipped, right_taken), either(left_taken, right_skipped)
+
+
+def process_condition(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    code = state.cfg.code
+    pc = instruction.pc
+
+    # Comparison used as a value: JMPxx +2, PUSHNILJMP, PUSHINT 1
+    if pc + 2 < len(code) and code[pc + 1].op == OP.PUSHNILJMP:
+        state.stack.append(ASTExpression('({0})', [jump_condition(instruction, state, False)]))
+        cursor.seek(pc + 3)
+        return None
+
+    # Conditions joined by 'or' and 'and' are one jump for each operand
+    end = state.ends[-1]
+    found = branches(instruction, state, end)
+    final, target, tree = merge_branches(found)
+
+    conditions = []
+    for i in range(final + 1):
+        jump = found[i][0]
+        if i:
+            process_block(cursor, chunk, state, jump)
+            cursor.seek(jump + 1)
+        conditions.append(jump_conditions(code[jump], state))
+
+    taken, condition = compound(tree, conditions)
+    pc = found[final][0]
+
+    # Jump out of the enclosing loop
+    if state.exits and target == state.exits[-1]:
+        return ASTCondition(taken, [ASTBreak()])
+
+    if target > end:
+        raise ValueError(f'{OP_NAME[code[pc].op]} at {pc} jumps to {target}, past the end of its block at {end}')
+
+    then_end = target
+    else_end = None
+
+    # if-else: the then block ends with a jump over the else block to the join point
+    last = code[then_end - 1]
+    if last.op == OP.JMP and last.pc > pc:
+        join = jump_target(last)
+        if target < join <= end and join not in state.exits and \
+                state.cfg.join(state.cfg.block_of(pc)) in (join, None):
+            then_end -= 1
+            else_end = join
+
+    block = process_block(cursor, chunk, state, then_end)
+
+    else_block = None
+    if else_end is not None:
+        cursor.seek(then_end + 1)
+        else_block = process_block(cursor, chunk, state, else_end)
+
+    return ASTCondition(condition, block, else_block)
+
+
+def process_and_or(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    # JMPONT/JMPONF keep the left operand as result if the jump is taken, else evaluate the right operand
+    left = state.stack.pop()
+
+    process_block(cursor, chunk, state, forward_target(instruction, state.cfg.code))
+    right = state.stack.pop()
+
+    template = '({0} or {1})' if instruction.op == OP.JMPONT else '({0} and {1})'
+    state.stack.append(ASTExpression(template, [left, right]))
+    return None
+
+
+def process_jump(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    if state.exits and jump_target(instruction) == state.exits[-1]:
+        return ASTBreak()
+    return None
+
+
+def process_for(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+    loop = forward_target(instruction, state.cfg.code) - 1  # FORLOOP/LFORLOOP
+
+    if instruction.op == OP.FORPREP:
+        start, limit, step = state.pop(3)
     else:
-        condition = '#TODO condition'
-
-    block = []
-    nested_state = State()
-    operator = get_OP(it.next())
-    while operator != OP.END:
-        if operator in PROCESS:
-            block.append(PROCESS[operator](it, chunk, nested_state))
-        else:
-            build_stack(it, chunk, nested_state)
-        operator = get_OP(it.next())
+        table = state.stack.pop()
 
-    return ASTCondition(condition, block)
+    # The loop variables are the next locals
+    state.declare(len(state.stack))
+    slot = len(state.locals)
 
+    if instruction.op == OP.FORPREP:
+        variable = f'l{slot}'
+        state.locals.extend([variable, '(limit)', '(step)'])
+    else:
+        key, value = f'l{slot + 2}', f'l{slot + 3}'
+        state.locals.extend(['(table)', '(index)', key, value])
 
-PROCESS = {
-    OP.CLOSURE:     process_closure,
-    OP.CALL:        process_call,
-    OP.SETGLOBAL:   process_assignment,
-    OP.SETTABLE:    process_set_table,
-    OP.CREATETABLE: process_create_table,
-    OP.SETMAP:      process_map,
-    OP.JMPNE:       process_condition,
-    OP.JMPEQ:       process_condition,
-    OP.JMPLT:       process_condition,
-    OP.JMPLE:       process_condition,
-    OP.JMPGT:       process_condition,
-    OP.JMPGE:       process_condition,
-    OP.JMPT:        process_condition,
-    OP.JMPF:        process_condition,
-}
+    state.exits.append(loop + 1)
+    block = process_block(cursor, chunk, state, loop)
+    cursor.seek(loop + 1)
+    state.exits.pop()
 
+    del state.locals[slot:]
 
-def build_stack(it: Iterator, chunk: Chunk, state: State):
-    instruction = it.get()
-    operator = get_OP(instruction)
+    if instruction.op == OP.FORPREP:
+        return ASTFor(variable, start, limit, step, block)
+    return ASTForIn(key, value, table, block)
 
-    # Get
 
-    if operator == OP.GETGLOBAL:
-        value = chunk.strings[get_B(instruction)]
+def process_loop(cursor: Cursor, chunk: Chunk, state: State, latch: Block):
+    code = state.cfg.code
+    header = cursor.pc
+    exit = latch.end
+    back = code[latch.end - 1]
+    first = code[state.cfg.block_of(header).end - 1]
 
-    elif operator == OP.GETLOCAL:
-        index = get_B(instruction)
+    state.headers.add(header)
+    state.exits.append(exit)
 
-        # Create local variable names (SWBF does not store local variable names)
-        while len(state.locals) <= index:
-            state.locals.append(f'l{len(state.locals)}')
+    if back.op == OP.JMP:
+        # while: the header ends with the jump that leaves the loop, the latch jumps back to the header
+        condition = ASTPrimitive(1)
+        if first.op in CONDITIONS and jump_target(first) == exit:
+            process_block(cursor, chunk, state, first.pc)
+            condition = jump_condition(first, state, True)
+            cursor.seek(first.pc + 1)
+
+        block = process_block(cursor, chunk, state, back.pc)
+        cursor.seek(back.pc + 1)
+        statement = ASTWhile(condition, block)
+
+    else:
+        # repeat: the latch evaluates the condition and jumps back while it is false
+        block = process_block(cursor, chunk, state, back.pc)
+        statement = ASTRepeat(block, jump_condition(back, state, True))
+        cursor.seek(back.pc + 1)
 
-        value = state.locals[index]
+    state.exits.pop()
+    state.headers.discard(header)
 
-    elif operator == OP.GETDOTTED:
-        left = state.stack.pop()
-        right = chunk.strings[get_B(instruction)]
-        value = f'{left.print()}.{right}'
+    return statement
 
-    # Push
 
-    elif operator == OP.PUSHNIL:
-        value = 'nil'
+def constant(instruction: Instruction, state: State):
+    return instruction.value
 
-    elif operator == OP.PUSHINT:
-        value = get_S(instruction) + 1  # unclear why +1 is necessary
 
-    elif operator == OP.PUSHNUM:
-        value = chunk.numbers[get_B(instruction)]
+def string(instruction: Instruction, state: State):
+    return quote(instruction.value)
 
-    elif operator == OP.PUSHNEGNUM:
-        value = chunk.numbers[get_B(instruction)] * -1
 
-    elif operator == OP.PUSHSTRING:
-        value = f'"{chunk.strings[get_B(instruction)]}"'
+def integer(instruction: Instruction, state: State):
+    return instruction.s + 1  # unclear why +1 is necessary
 
-    # Arithmetic
 
-    elif operator == OP.MULT:
-        right = state.stack.pop()
-        left = state.stack.pop()
-        value = f'({left.print()} * {right.print()})'
+def local(instruction: Instruction, state: State):
+    return state.local(instruction.u)
 
-    elif operator == OP.ADDI:
-        value = f' + {get_B(instruction)}'
 
-    elif operator == OP.ADD:
-        right = state.stack.pop()
-        left = state.stack.pop()
-        value = f'({left.print()} + {right.print()})'
+def upvalue(instruction: Instruction, state: State):
+    if instruction.u < len(state.upvalues):
+        return state.upvalues[instruction.u]
+    return f'u{instruction.u}'
 
-    elif operator == OP.SUB:
-        right = state.stack.pop()
-        left = state.stack.pop()
-        value = f'({left.print()} - {right.print()})'
+
+# Operators that pop a fixed number of values and push one expression:
+#   operator: (popped values, format of the expression, decoded operand)
+# The format gets the popped values, the deepest first, and the operand
+EXPRESSIONS = {
+    OP.PUSHINT:     (0, '{operand}', integer),
+    OP.PUSHSTRING:  (0, '{operand}', string),
+    OP.PUSHNUM:     (0, '{operand}', constant),
+    OP.PUSHNEGNUM:  (0, '-{operand}', constant),
+    OP.PUSHUPVALUE: (0, '%{operand}', upvalue),
+    OP.GETLOCAL:    (0, '{operand}', local),
+    OP.GETGLOBAL:   (0, '{operand}', constant),
+    OP.GETDOTTED:   (1, '{0}.{operand}', constant),
+    OP.GETINDEXED:  (1, '{0}[{operand}]', local),
+    OP.ADD:         (2, '({0} + {1})', None),
+    OP.ADDI:        (1, '({0} + {operand})', integer),
+    OP.SUB:         (2, '({0} - {1})', None),
+    OP.MULT:        (2, '({0} * {1})', None),
+    OP.DIV:         (2, '({0} / {1})', None),
+    OP.POW:         (2, '({0} ^ {1})', None),
+    OP.MINUS:       (1, '-{0}', None),
+    OP.NOT:         (1, 'not {0}', None),
+}
+
+
+def expression(pops: int, template: str, operand):
+    # Values without children are leaves, equal leaves of a function share one node
+    if pops == 0:
+        def process_expression(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+            value = operand(instruction, state) if operand else None
+            leaf = state.leaves.get((instruction.op, value))
+            if leaf is None:
+                leaf = ASTPrimitive(value if template == '{operand}' else template.format(operand=value))
+                state.leaves[(instruction.op, value)] = leaf
+            state.stack.append(leaf)
 
     else:
-        print('#TODO:', OP_NAME[operator])
-        return
+        def process_expression(instruction: Instruction, cursor: Cursor, chunk: Chunk, state: State):
+            value = operand(instruction, state) if operand else None
+            state.stack.append(ASTExpression(template, tuple(state.pop(pops)), value))
+
+    return process_expression
+
+
+PROCESS = {
+    OP.END:         process_nothing,
+    OP.RETURN:      process_return,
+    OP.CALL:        process_call,
+    OP.TAILCALL:    process_tail_call,
+    OP.PUSHNIL:     process_push_nil,
+    OP.POP:         process_pop,
+    OP.GETTABLE:    process_get_table,
+    OP.PUSHSELF:    process_push_self,
+    OP.CREATETABLE: process_create_table,
+    OP.SETLOCAL:    process_set_local,
+    OP.SETGLOBAL:   process_set_global,
+    OP.SETTABLE:    process_set_table,
+    OP.SETLIST:     process_set_list,
+    OP.SETMAP:      process_set_map,
+    OP.CONCAT:      process_concat,
+    OP.JMPNE:       process_condition,
+    OP.JMPEQ:       process_condition,
+    OP.JMPLT:       process_condition,
+    OP.JMPLE:       process_condition,
+    OP.JMPGT:       process_condition,
+    OP.JMPGE:       process_condition,
+    OP.JMPT:        process_condition,
+    OP.JMPF:        process_condition,
+    OP.JMPONT:      process_and_or,
+    OP.JMPONF:      process_and_or,
+    OP.JMP:         process_jump,
+    OP.PUSHNILJMP:  expression(0, 'nil', None),  # Only reached outside of a comparison used as a value
+    OP.FORPREP:     process_for,
+    OP.FORLOOP:     process_nothing,  # Consumed by process_for
+    OP.LFORPREP:    process_for,
+    OP.LFORLOOP:    process_nothing,  # Consumed by process_for
+    OP.CLOSURE:     process_closure,
+}
+
+for operator, (pops, template, operand) in EXPRESSIONS.items():
+    PROCESS[operator] = expression(pops, template, operand)
+
+# Handler of every operator, indexed by the operator
+HANDLERS = [PROCESS[operator] for operator in range(len(OP_NAME))]
+
+CONDITIONS = set(COMPARISONS) | TESTS
+# Operators that only push a value, the operands of a condition (CALL if it has results)
+OPERANDS = set(EXPRESSIONS) | {OP.PUSHNIL, OP.GETTABLE, OP.PUSHSELF, OP.CONCAT}
+LOOPS = {OP.JMP} | CONDITIONS
+
+
+def process_block(cursor: Cursor, chunk: Chunk, state: State, end: int) -> list:
+    # Processes the instructions before pc 'end'. Handlers are called with the cursor on the next instruction and
+    # leave it on the first instruction they did not consume
+    statements = []
+    verbose = tracing.enabled(tracing.TRACE)
+    handlers = HANDLERS
+    code = cursor.code
+    loops = state.cfg.loops
+    pending = state.pending
+    state.ends.append(end)
+
+    while cursor.pc < end:
+        instruction = code[cursor.pc]
+        if verbose:
+            tracing.log(tracing.TRACE, '##', OP_NAME[instruction.op], instruction.pc)
+
+        if instruction.pc in loops and instruction.pc not in state.headers and \
+                code[max(x.end for x in loops[instruction.pc]) - 1].op in LOOPS:
+            statement = process_loop(cursor, chunk, state, max(loops[instruction.pc], key=lambda x: x.end))
+        else:
+            cursor.pc += 1
+            statement = handlers[instruction.op](instruction, cursor, chunk, state)
+
+        if pending:
+            statements.extend(pending)
+            pending.clear()
 
-    state.stack.append(ASTPrimitive(value))
+        if statement is not None:
+            statements.append(statement)
 
+    state.ends.pop()
+    return statements
 
-def process_chunk(chunk: Chunk):
-    it = Iterator(chunk.instructions)
+
+def process_chunk(chunk: Chunk, upvalues: [str] = None):
+    code = decode(chunk)
+    cursor = Cursor(code)
 
     #print(f'{chunk.name=}, {chunk.parameters=}, {len(chunk.functions)=}, {chunk.stacks=}, {len(chunk.strings)=}, {len(chunk.numbers)=}')
 
-    state = State()
+    state = State(CFG(code), upvalues)
 
     root = ASTRoot()
 
-    # Parameter definition at the start of a chunk
+    # Parameter definition at the start of a chunk, parameters are the first locals. The extra arguments of a
+    # variadic function are the table in the local 'arg' after them
     for parameter in range(chunk.parameters):
         state.parameters.append(f'p{parameter}')
-        it.next()
+    state.locals.extend(state.parameters)
+    if chunk.variadic:
+        state.locals.append('arg')
 
-    # Local variable definition at the start of a chunk #TODO
-    local = 0
-    while get_OP(it.get()) == OP.PUSHINT:
-        name = f'l{local}'
-        value = get_B(it.get())
-        state.locals.append(name)
-        it.next()
-        local += 1
+    for statement in process_block(cursor, chunk, state, len(code)):
+        root += statement
 
-        root += ASTAssignment(ASTPrimitive(name), ASTPrimitive(value))
+    # Locals that are never used
+    state.declare(len(state.stack))
+    for statement in state.pending:
+        root += statement
 
-    try:
-        while it:
-            operator = get_OP(it.get())
-            print('##', OP_NAME[operator], it._pos)
+    return root
 
-            if operator in PROCESS:
-                root += PROCESS[operator](it, chunk, state)
 
-            elif operator == OP.END:  # End of chunk
-                pass
+def main(file: Path):
+    profiling.begin('script', file, file.stat().st_size if profiling.enabled() else 0)
 
-            else:
-                build_stack(it, chunk, state)
+    with profiling.phase('load'), open(file, 'rb') as f:
+        chunk = chunkfile.load(f)
 
-            it.next()
+    decompile(chunk, str(file.parent / file.stem) + '.lua')
 
-    except StopIteration as e:
-        pass
-    except Exception as e:
-        print(e)
 
-    return root
+def decompile(chunk: Chunk, script_name: str):
+    # Unchanged scripts are copied from the cache
+    key = None
+    if scripts is not None:
+        with profiling.phase('cache'):
+            key = cache.key(cache.chunk_hash(chunk), VERSION)
+            text = scripts.get(key)
+        if text is not None:
+            print(script_name)
+            with profiling.phase('render'), open(script_name, 'w') as script:
+                script.write(text)
+            return
 
+    with profiling.phase('decompile'):
+        ast = process_chunk(chunk)
 
-def debug(chunk: Chunk, level: int = 0):
-    def printf(i):
-        op = get_OP(i)
-        print(
-            '{} '
-            '{:<15} {:>10} {:>10} {:>10} {:>10} {:>14} {:>20} {:<10}'.format(
-                '  ' * level,
-                OP_NAME[op], i, get_U(i), get_B(i), get_Bx(i), get_S(i), bin(get_U(i)),
-                '' if get_B(i) >= len(chunk.strings) else chunk.strings[get_B(i)]))
+    if profiling.enabled():
+        profiling.count('instructions', count_instructions(chunk))
 
-    it = Iterator(chunk.instructions)
-    while it:
-        printf(it.get())
+    if tracing.enabled(tracing.DEBUG):
+        disasm.disassemble(chunk, tracing.out)
 
-        it.next()
+    print(script_name)
 
-    it.prev()
+    with profiling.phase('render'), open(script_name, 'w') as script:
+        if key is None:
+            ast.emit(Emitter(script))
+        else:
+            text = render(ast)
+            script.write(text)
+            scripts.put(key, text)
 
-    printf(it.next())
 
+def source(chunk: Chunk) -> str:
+    # The decompiled script as text, for server.py
+    key = None
+    if scripts is not None:
+        key = cache.key(cache.chunk_hash(chunk), VERSION)
+        text = scripts.get(key)
+        if text is not None:
+            return text
 
-def main(file: Path):
-    chunk = pickle.load(open(file, 'rb'))
+    text = render(process_chunk(chunk))
+    if key is not None:
+        scripts.put(key, text)
+    return text
 
-    def rec(c: Chunk):
-        idx = 0
-        for i in Iterator(c.instructions):
-            if get_OP(i) == OP.CLOSURE:
-                rec(c.functions[idx])
-                idx += 1
-            print(OP_NAME[get_OP(i)])
-    rec(chunk)
 
-    ast = process_chunk(chunk)
+def run_worker(file: Path, connection, trace_level: int, profiled: bool, cache_folder, cache_size: int):
+    start = time.perf_counter()
+    traced = io.StringIO()
+    tracing.configure(trace_level, traced)
+    profiling.configure(profiled)
+    configure_cache(cache_folder, cache_size)
 
-    print(
-        '{} '
-        '{:<15} {:>10} {:>10} {:>10} {:>10} {:>14} {:>20} {:<10}'.format('', 'OP', 'code', 'U', 'B', 'Bx', 'S', 'bits', 'str'))
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        try:
+            main(file)
+            status, error = 'ok', ''
 
-    debug(chunk)
+        except Exception as e:
+            status, error = 'failed', f'{type(e).__name__}: {e}'
 
-    script_name = str(file.parent / file.stem) + '.lua'
-    print(script_name)
+    connection.send((status, error, output.getvalue(), traced.getvalue(), time.perf_counter() - start,
+                     profiling.records))
 
-    with open(script_name, 'w') as script:
-        script.write(ast.print(0))
+
+def duplicates(files: list):
+    # Clusters of equal nested functions in all files, the ones that save the most instructions first.
+    # The functions nested in a copy are not decompiled either, so they are not counted again
+    clusters = {}
+    instructions = 0
+
+    for file in files:
+        with open(file, 'rb') as f:
+            chunk = chunkfile.load(f)
+        instructions += count_instructions(chunk)
+
+        # Nested functions come right after their parent, those of a copy are skipped up to the next other path
+        copy = None
+        for path, function in functions(chunk):
+            if not path or copy is not None and path.startswith(copy):
+                continue
+            copy = None
+
+            size, locations = clusters.setdefault(cache.chunk_hash(function), (count_instructions(function), []))
+            locations.append(f'{file}:{path}')
+            if len(locations) > 1:
+                copy = path + '.'
+
+    nested = sum(len(x[1]) for x in clusters.values())
+    clusters = sorted((x for x in clusters.values() if len(x[1]) > 1), key=lambda x: -(len(x[1]) - 1) * x[0])
+    copies = sum(len(x[1]) - 1 for x in clusters)
+    saved = sum((len(x[1]) - 1) * x[0] for x in clusters)
+
+    print(f'\n{"copies":>8} {"instructions":>12}  functions')
+    for size, locations in clusters:
+        print(f'{len(locations):>8} {size:>12}  {", ".join(locations[:3])}{", ..." if len(locations) > 3 else ""}')
+
+    print(f'{len(clusters)} clusters: {copies} of {nested} nested functions are copies, '
+          f'{saved} of {instructions} instructions ({saved / max(instructions, 1):.0%}) are in copies')
+
+
+def main_parallel(files: list, jobs: int, timeout: float):
+    start = time.perf_counter()
+    pending = list(enumerate(files))
+    running = {}
+    results = [None] * len(files)
+    cache_settings = (scripts.folder, scripts.max_size) if scripts is not None else (None, 0)
+
+    # Every file is decompiled in its own process, so a crash or a hang only affects that file
+    while pending or running:
+        while pending and len(running) < jobs:
+            index, file = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=run_worker, args=(file, sender, tracing.level, profiling.enabled(), *cache_settings), daemon=True)
+            process.start()
+            sender.close()
+            running[receiver] = (index, process, time.perf_counter())
+
+        deadline = min(started for _, _, started in running.values()) + timeout
+        for receiver in wait(list(running), max(0.0, deadline - time.perf_counter())):
+            index, process, started = running.pop(receiver)
+
+            try:
+                results[index] = receiver.recv()
+                process.join()
+
+            except EOFError:
+                process.join()
+                results[index] = ('failed', f'worker exited with code {process.exitcode}', '', '',
+                                  time.perf_counter() - started, [])
+
+        for receiver, (index, process, started) in list(running.items()):
+            if time.perf_counter() - started > timeout:
+                process.kill()
+                process.join()
+                del running[receiver]
+                results[index] = ('timeout', f'no result after {timeout} s', '', '', time.perf_counter() - started,
+                                  [])
+
+    for file, (status, error, output, traced, elapsed, records) in zip(files, results):
+        tracing.out.write(traced)
+        print(output, end='')
+        profiling.records.extend(records)
+
+    print()
+    for file, (status, error, output, traced, elapsed, records) in zip(files, results):
+        print(f'{status:<8} {elapsed:>8.2f} s  {file}{": " + error if error else ""}')
+
+    statuses = [status for status, _, _, _, _, _ in results]
+    print(f'{len(files)} files: {statuses.count("ok")} ok, {statuses.count("failed")} failed, '
+          f'{statuses.count("timeout")} timed out in {time.perf_counter() - start:.2f} s')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Produces a \'*.lua\' script file.\n'
+                    'Use \'*\' wildcard for multiple files with a target folder (*.dat mission).')
+    parser.add_argument('files', nargs='+', help='\'*.dat\' files, or a wildcard and a folder')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help='number of worker processes')
+    parser.add_argument('--timeout', type=float, default=60.0, metavar='SECONDS',
+                        help='with --jobs, time limit for decompiling a single file')
+    parser.add_argument('--trace', choices=tracing.LEVELS, default='off',
+                        help='debug: disassembly of all functions, trace: also every decompiled instruction')
+    parser.add_argument('--trace-file', metavar='FILE', help='write the trace to FILE instead of stderr')
+    parser.add_argument('--cache', metavar='FOLDER',
+                        help='reuse decompiled scripts and nested functions with the same bytecode from FOLDER')
+    parser.add_argument('--cache-size', type=float, default=256.0, metavar='MB',
+                        help='with --cache, size limit of the cache folder, least recently used entries are removed')
+    parser.add_argument('--duplicates', action='store_true',
+                        help='print the clusters of equal nested functions, which are decompiled only once')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write the wall and CPU time of the phases of every file to FILE as JSON')
+    parser.add_argument('--profile-dump', metavar='FILE',
+                        help='write cProfile statistics of the main process to FILE')
+
     if len(sys.argv) < 2:
-        print('Pass one or more \'*.dat\' files as arguments.\n\n'
-              'Produces a \'*.lua\' script file.\n'
-              'Use \'*\' wildcard for multiple files with a target folder (*.dat mission).')
+        print('Pass one or more \'*.dat\' files as arguments.\n')
+        parser.print_help()
         exit(1)
 
-    if sys.argv[1][0] == '*':
-        files = Path(sys.argv[2]).glob(sys.argv[1])
+    args = parser.parse_args()
+
+    tracing.configure(tracing.LEVELS[args.trace], open(args.trace_file, 'w') if args.trace_file else None)
+    configure_cache(args.cache, int(args.cache_size * 1e6))
+    profiling.configure(args.profile is not None)
+    profiler = cProfile.Profile() if args.profile_dump else None
+    if profiler:
+        profiler.enable()
+
+    if args.files[0][0] == '*':
+        files = sorted(Path(args.files[1]).glob(args.files[0]))
     else:
-        files = sys.argv[1:]
+        files = [Path(file) for file in args.files]
 
-    for file in files:
-        main(Path(file))
+    if args.jobs > 1:
+        main_parallel(files, args.jobs, args.timeout)
+    else:
+        for file in files:
+            try:
+                main(file)
+
+            except Exception as e:
+                print(f'{file}: {type(e).__name__}: {e}')
+
+        if scripts is not None:
+            print(scripts)
+
+    if args.duplicates:
+        duplicates(files)
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile_dump)
+
+    if args.profile:
+        profiling.write('luadec', args.profile)
@@ -0,0 +1,95 @@
+import sys
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import chunkfile
+import luadec
+import unmunge
+from unmunge import Reader
+
+
+# Every scr_ chunk is decompiled as soon as it is parsed, the bytecode never goes through a '*.dat' file
+def convert_scr_(r: Reader, folder: Path, offset: int, dat: bool = False):
+    r.pos = offset + 8
+    name, size, chunk = unmunge.read_scr_(r)
+
+    if dat:
+        with open(folder / (name + '.dat'), 'wb') as file:
+            chunkfile.dump(chunk, file)
+
+    luadec.decompile(chunk, str(folder / name) + '.lua')
+
+
+def convert_file_scr_(file, folder: Path, offset: int, dat: bool = False):
+    # Worker processes keep the container mapped between the scr_ chunks of the same file
+    convert_scr_(Reader(unmunge.map_file(file)), folder, offset, dat)
+
+
+def scripts(file, folder: Path, r: Reader) -> list:
+    # Only the chunk headers are read here, the scr_ bodies are parsed by convert_scr_
+    index = unmunge.get_index(file, folder, r, save=False)
+    return [(offset, script_name) for chunk_name, offset, chunk_size, script_name, digest in index or []
+            if chunk_name == 'scr_']
+
+
+def main(file, folder: Path, mapped: bool = False, dat: bool = False):
+    r = unmunge.open_reader(file, mapped)
+
+    for offset, script_name in scripts(file, folder, r):
+        try:
+            convert_scr_(r, folder, offset, dat)
+
+        except Exception as e:
+            print(f'{script_name}: {type(e).__name__}: {e}')
+
+
+def main_parallel(files: list, jobs: int, dat: bool = False):
+    cache_settings = (luadec.scripts.folder, luadec.scripts.max_size) if luadec.scripts is not None else (None, 0)
+
+    with ProcessPoolExecutor(jobs, initializer=luadec.configure_cache, initargs=cache_settings) as pool:
+        tasks = []
+
+        # The scr_ chunks of all files are spread across the workers, the first scripts are decompiled while the
+        # headers of the later files are still being read
+        for file in files:
+            folder = unmunge.output_folder(file)
+
+            for offset, script_name in scripts(file, folder, unmunge.open_reader(file, mapped=True)):
+                tasks.append(pool.submit(unmunge.run_captured, convert_file_scr_, file, folder, offset, dat))
+
+        # Output is printed in input order, regardless of which worker finishes first
+        for task in tasks:
+            print(task.result(), end='')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Unmunges \'*.lvl\' or \'*.script\' files and decompiles their \'scr_\' chunks to \'*.lua\' '
+                    'script files in one step.')
+    parser.add_argument('files', nargs='+', help='\'*.lvl\' or \'*.script\' files')
+    parser.add_argument('--mmap', action='store_true', help='memory-map the input files instead of reading them')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help='number of worker processes')
+    parser.add_argument('--dat', action='store_true', help='also write the \'*.dat\' files of unmunge.py')
+    parser.add_argument('--cache', metavar='FOLDER',
+                        help='reuse decompiled scripts and nested functions with the same bytecode from FOLDER')
+    parser.add_argument('--cache-size', type=float, default=256.0, metavar='MB',
+                        help='with --cache, size limit of the cache folder, least recently used entries are removed')
+
+    if len(sys.argv) < 2:
+        print('Pass one or more \'*.lvl\' files as arguments.\n')
+        parser.print_help()
+        exit(1)
+
+    args = parser.parse_args()
+
+    luadec.configure_cache(args.cache, int(args.cache_size * 1e6))
+
+    if args.jobs > 1:
+        main_parallel(args.files, args.jobs, args.dat)
+    else:
+        for file in args.files:
+            main(file, unmunge.output_folder(file), args.mmap, args.dat)
+
+        if luadec.scripts is not None:
+            print(luadec.scripts)
@@ -0,0 +1,88 @@
+import time
+import json
+import contextlib
+
+# Wall and CPU time of the phases of every file and script, see --profile of unmunge.py and luadec.py
+active = False
+records = []
+record = None
+start = (0.0, 0.0)
+
+
+def configure(enabled: bool):
+    global active, records, record, start
+    active = enabled
+    records = []
+    record = None
+    start = (time.perf_counter(), time.process_time())
+
+
+def enabled() -> bool:
+    return active
+
+
+def begin(kind: str, name: str, size: int = 0):
+    # Phases and counts are added to this record of a file or script until the next one begins
+    global record
+    if active:
+        record = {'kind': kind, 'name': str(name), 'bytes': size, 'instructions': 0, 'phases': {}}
+        records.append(record)
+
+
+def count(key: str, n: int):
+    if record is not None:
+        record[key] += n
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    if record is None:
+        yield
+        return
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        times = record['phases'].setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+        times['wall'] += time.perf_counter() - wall
+        times['cpu'] += time.process_time() - cpu
+
+
+def report(program: str) -> dict:
+    phases = {}
+    totals = {}
+    for r in records:
+        for name, times in r['phases'].items():
+            total = phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            total['wall'] += times['wall']
+            total['cpu'] += times['cpu']
+
+        total = totals.setdefault(r['kind'], {'count': 0, 'bytes': 0, 'instructions': 0})
+        total['count'] += 1
+        total['bytes'] += r['bytes']
+        total['instructions'] += r['instructions']
+
+    return {
+        'program': program,
+        'wall': time.perf_counter() - start[0],
+        'cpu': time.process_time() - start[1],
+        'phases': phases,
+        'totals': totals,
+        'records': records
+    }
+
+
+def write(program: str, file):
+    # The JSON report goes to the file, a summary of the phases to stdout
+    data = report(program)
+
+    with open(file, 'w') as f:
+        json.dump(data, f, indent=1)
+
+    print(f'\n{"phase":<12} {"wall s":>10} {"cpu s":>10}')
+    for name, times in data['phases'].items():
+        print(f'{name:<12} {times["wall"]:>10.3f} {times["cpu"]:>10.3f}')
+    print(f'{"total":<12} {data["wall"]:>10.3f} {data["cpu"]:>10.3f}')
+    for kind, total in data['totals'].items():
+        print(f'{total["count"]} {kind}s, {total["bytes"] / 1e6:.2f} MB, {total["instructions"]} instructions')
@@ -0,0 +1,256 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from pathlib import Path
+
+import chunkfile
+from shared import Chunk, functions
+from lua4 import OP, OP_NAME, decode
+
+SCHEMA_VERSION = 2
+
+# Length of the opcode sequences in the index, longer patterns are joined from several of them
+NGRAM = 3
+
+# Every instruction is indexed under these terms, at its function and pc:
+#   op:GETGLOBAL                 the opcode
+#   op:GETGLOBAL:SetProperty     the opcode and its string or number constant
+#   const:SetProperty            the constant, with any opcode
+#   ngram:GETGLOBAL GETDOTTED CALL   the opcodes from the pc on
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime INTEGER);
+CREATE TABLE IF NOT EXISTS functions (id INTEGER PRIMARY KEY, file INTEGER, path TEXT);
+CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, text TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS postings (term INTEGER, function INTEGER, pc INTEGER,
+                                     PRIMARY KEY (term, function, pc)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS functions_file ON functions (file);
+CREATE INDEX IF NOT EXISTS postings_function ON postings (function);
+'''
+
+
+def connect(file) -> sqlite3.Connection:
+    connection = sqlite3.connect(file)
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+
+    if version not in (0, SCHEMA_VERSION):
+        raise ValueError(f'{file}: unsupported index version {version}, remove it to build a new one')
+
+    connection.executescript(SCHEMA)
+    connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    return connection
+
+
+def normalize(text: str) -> str:
+    # Numbers are indexed and looked up in one form, 41, 41.0 and 4.1e1 are all 41
+    if any(x.isdigit() for x in text):
+        try:
+            value = float(text)
+        except ValueError:
+            return text
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    return text
+
+
+def constant_text(instruction):
+    # The string or number constant of the instruction as written in the script, PUSHINT included
+    if instruction.op == OP.PUSHINT:
+        return str(instruction.s + 1)
+    if instruction.value is None:
+        return None
+    if instruction.op == OP.PUSHNEGNUM:
+        return normalize(str(-instruction.value))
+    return normalize(str(instruction.value))
+
+
+def terms(chunk: Chunk):
+    code = decode(chunk)
+    ops = [OP_NAME[x.op] for x in code]
+
+    for instruction, op in zip(code, ops):
+        pc = instruction.pc
+        yield f'op:{op}', pc
+
+        value = constant_text(instruction)
+        if value is not None:
+            yield f'op:{op}:{value}', pc
+            yield f'const:{value}', pc
+
+        if pc + NGRAM <= len(ops):
+            yield 'ngram:' + ' '.join(ops[pc:pc + NGRAM]), pc
+
+
+class Index:
+    def __init__(self, file):
+        self.db = connect(file)
+        self.terms = None
+
+    def term_id(self, text: str) -> int:
+        if self.terms is None:
+            self.terms = dict(self.db.execute('SELECT text, id FROM terms'))
+
+        id = self.terms.get(text)
+        if id is None:
+            id = self.db.execute('INSERT INTO terms (text) VALUES (?)', (text,)).lastrowid
+            self.terms[text] = id
+        return id
+
+    def remove(self, file_id: int):
+        self.db.execute('DELETE FROM postings WHERE function IN (SELECT id FROM functions WHERE file = ?)', (file_id,))
+        self.db.execute('DELETE FROM functions WHERE file = ?', (file_id,))
+        self.db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def add(self, path: str, stat: os.stat_result, chunk: Chunk):
+        file_id = self.db.execute('INSERT INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                                  (path, stat.st_size, stat.st_mtime_ns)).lastrowid
+        postings = set()
+
+        for function_path, function in functions(chunk):
+            function_id = self.db.execute('INSERT INTO functions (file, path) VALUES (?, ?)',
+                                          (file_id, function_path)).lastrowid
+            postings.update((self.term_id(text), function_id, pc) for text, pc in terms(function))
+
+        self.db.executemany('INSERT INTO postings VALUES (?, ?, ?)', postings)
+
+    def update(self, files: [Path]) -> (int, int, int):
+        # Only files whose size or modification time changed are read again, files that no longer exist are removed
+        known = {path: (id, size, mtime) for id, path, size, mtime in self.db.execute('SELECT * FROM files')}
+        added = unchanged = removed = 0
+
+        with self.db:
+            for file in files:
+                path = str(file)
+                stat = file.stat()
+                entry = known.pop(path, None)
+
+                if entry is not None:
+                    if entry[1:] == (stat.st_size, stat.st_mtime_ns):
+                        unchanged += 1
+                        continue
+                    self.remove(entry[0])
+
+                try:
+                    with open(file, 'rb') as f:
+                        chunk = chunkfile.load(f)
+                    self.add(path, stat, chunk)
+                    added += 1
+
+                except Exception as e:
+                    print(f'{file}: {type(e).__name__}: {e}')
+
+            for path, (id, size, mtime) in known.items():
+                if not os.path.exists(path):
+                    self.remove(id)
+                    removed += 1
+
+        return added, unchanged, removed
+
+    def count(self, text: str) -> int:
+        return self.db.execute('SELECT count(*) FROM postings WHERE term = (SELECT id FROM terms WHERE text = ?)',
+                               (text,)).fetchone()[0]
+
+    def query(self, pattern: list) -> list:
+        # Every term of the pattern must be found at the same function, at the pc of the match plus its offset.
+        # The join starts with the term that has the fewest postings
+        conditions = sorted(pattern_terms(pattern), key=lambda x: self.count(x[0]))
+        if not conditions:
+            return []
+
+        (first, offset), others = conditions[0], conditions[1:]
+        sql = f'SELECT files.path, functions.path, p0.pc - {offset} FROM postings p0 '
+        parameters = []
+
+        for i, (text, other_offset) in enumerate(others, 1):
+            sql += f'JOIN postings p{i} ON p{i}.function = p0.function AND p{i}.pc = p0.pc + {other_offset - offset} ' \
+                   f'AND p{i}.term = (SELECT id FROM terms WHERE text = ?) '
+            parameters.append(text)
+
+        sql += 'JOIN functions ON functions.id = p0.function JOIN files ON files.id = functions.file ' \
+               'WHERE p0.term = (SELECT id FROM terms WHERE text = ?) ' \
+               'ORDER BY files.path, functions.path, p0.pc'
+        parameters.append(first)
+
+        return self.db.execute(sql, parameters).fetchall()
+
+
+def parse_pattern(text: str) -> list:
+    # 'GETGLOBAL x; GETDOTTED y; CALL': an opcode ('*' for any) and an optional constant per instruction.
+    # A single word that is no opcode is a constant with any opcode
+    pattern = []
+
+    for step in text.split(';'):
+        op, _, constant = step.strip().partition(' ')
+        constant = normalize(constant.strip()) or None
+
+        if op != '*' and op not in OP_NAME:
+            if len(text.split(';')) > 1 or constant is not None:
+                raise ValueError(f'unknown opcode \'{op}\'')
+            op, constant = '*', normalize(step.strip())
+
+        pattern.append((None if op == '*' else op, constant))
+
+    return pattern
+
+
+def pattern_terms(pattern: list) -> list:
+    # (term, offset) pairs, opcode sequences are looked up as n-grams where possible
+    result = []
+    covered = set()
+
+    for i in range(len(pattern) - NGRAM + 1):
+        ops = [op for op, constant in pattern[i:i + NGRAM]]
+        if None not in ops and not covered.issuperset(range(i, i + NGRAM)):
+            result.append(('ngram:' + ' '.join(ops), i))
+            covered.update(range(i, i + NGRAM))
+
+    for i, (op, constant) in enumerate(pattern):
+        if constant is not None:
+            result.append((f'op:{op}:{constant}' if op else f'const:{constant}', i))
+        elif op is not None and i not in covered:
+            result.append((f'op:{op}', i))
+
+    return result
+
+
+def dat_files(paths: list) -> list:
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.rglob('*.dat')) if path.is_dir() else [path])
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Finds constants and instruction patterns in \'*.dat\' files. \'index\' adds the files to the '
+                    'index or updates them, \'query\' prints every match as file:function:pc.')
+    parser.add_argument('command', choices=['index', 'query'])
+    parser.add_argument('arguments', nargs='+',
+                        help='index: \'*.dat\' files or folders, query: a constant or a pattern like '
+                             '\'GETGLOBAL x; GETDOTTED y; CALL\' (\'*\' matches any opcode)')
+    parser.add_argument('--index', default='luadec.idx.db', metavar='FILE', help='index file (luadec.idx.db)')
+
+    if len(sys.argv) < 2:
+        parser.print_help()
+        exit(1)
+
+    args = parser.parse_args()
+    index = Index(args.index)
+    start = time.perf_counter()
+
+    if args.command == 'index':
+        added, unchanged, removed = index.update(dat_files(args.arguments))
+        print(f'{added} files indexed, {unchanged} unchanged, {removed} removed in {time.perf_counter() - start:.2f} s')
+
+    else:
+        try:
+            pattern = parse_pattern(' '.join(args.arguments))
+        except ValueError as e:
+            parser.error(str(e))
+
+        matches = index.query(pattern)
+        for file, function, pc in matches:
+            print(f'{file}:{function}:{pc}')
+        print(f'{len(matches)} matches in {(time.perf_counter() - start) * 1000:.1f} ms')
@@ -0,0 +1,365 @@
+import io
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import hashlib
+import argparse
+import threading
+import multiprocessing
+import socketserver
+import collections
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import luadec
+import disasm
+import unmunge
+import shared
+import chunkfile
+from shared import Chunk
+
+# Larger requests are rejected
+MAX_REQUEST = 64 * 1024 * 1024
+
+# Latencies of the last requests of every endpoint, for the percentiles of /stats
+LATENCIES = 10000
+
+PERCENTILES = (50, 90, 99)
+
+CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Decoded chunks of the worker processes by the hash of the request body, see configure_worker
+chunks = {}
+max_chunks = 0
+
+
+def configure_worker(cache_folder, cache_size: int, chunk_limit: int):
+    global max_chunks
+    # The string pool would keep the constants of every request, the caches below are bounded instead
+    shared.configure_interning(False)
+    luadec.configure_cache(cache_folder, cache_size)
+    max_chunks = chunk_limit
+
+
+def parse(data: bytes) -> Chunk:
+    # A chunk file of unmunge.py, a scr_ chunk or the Lua bytecode of its body. Pickled '*.dat' files are not
+    # accepted, loading them could run any code
+    if data[:4] == chunkfile.MAGIC:
+        return chunkfile.loads(data)
+    if data[:4] == b'scr_':
+        return unmunge.read_scr_(unmunge.Reader(data, 8))[2]
+    if data[:5] == b'\x1bLua@':
+        return unmunge.handle_script(data)
+    raise ValueError('expected a chunk file, a \'scr_\' chunk or Lua 4.0 bytecode')
+
+
+def run(command: str, format: str, digest: bytes, data: bytes) -> str:
+    chunk = chunks.pop(digest, None)
+    if chunk is None:
+        chunk = parse(data)
+    chunks[digest] = chunk
+    if len(chunks) > max_chunks:
+        del chunks[next(iter(chunks))]
+
+    if command == 'decompile':
+        return luadec.source(chunk)
+
+    out = io.StringIO()
+    disasm.disassemble(chunk, out, format)
+    return out.getvalue()
+
+
+# Responses by command, format and request hash. When the total size exceeds max_size the least recently used
+# responses are removed
+class Memory:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            text = self.entries.pop(key, None)
+            if text is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries[key] = text
+            return text
+
+    def put(self, key, text: str):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = text
+            self.size += len(text)
+
+            while self.size > self.max_size and self.entries:
+                self.size -= len(self.entries.pop(next(iter(self.entries))))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'size': self.size}
+
+
+class Endpoint:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=LATENCIES)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        result = {'requests': self.requests, 'errors': self.errors}
+        for p in PERCENTILES:
+            result[f'p{p} ms'] = round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000, 3) \
+                if latencies else None
+        result['max ms'] = round(latencies[-1] * 1000, 3) if latencies else None
+        return result
+
+
+class Server:
+    def __init__(self, jobs: int, memory: int, chunk_limit: int, cache_folder=None, cache_size: int = 0,
+                 timeout: float = None):
+        self.jobs = jobs
+        self.timeout = timeout
+        self.settings = (cache_folder, cache_size, chunk_limit)
+        self.memory = Memory(memory)
+        self.endpoints = collections.defaultdict(Endpoint)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.restarts = 0
+        self.timeouts = 0
+        self.pool = self.start_pool()
+
+    def start_pool(self) -> ProcessPoolExecutor:
+        # Workers are started from request threads, forking there could copy locks held by other threads
+        return ProcessPoolExecutor(self.jobs, mp_context=CONTEXT, initializer=configure_worker,
+                                   initargs=self.settings)
+
+    def restart_pool(self, pool: ProcessPoolExecutor, kill: bool = False):
+        # Only the first request that finds the pool broken or stuck replaces it
+        with self.lock:
+            if self.pool is not pool:
+                return
+            self.pool = self.start_pool()
+            self.restarts += 1
+
+        if kill:
+            # A stuck worker does not return, the requests of the other workers of the pool fail and are retried
+            for process in list(pool._processes.values()):
+                process.kill()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def execute(self, command: str, format: str, data: bytes) -> (str, bool):
+        # The response text and whether it came from memory
+        digest = hashlib.blake2b(data, digest_size=20).digest()
+        key = (command, format, digest)
+
+        text = self.memory.get(key)
+        if text is not None:
+            return text, True
+
+        # When a worker crashed, the request is tried once more in a new pool. A request that crashes that one too
+        # fails. A request that takes longer than the timeout fails, its pool is killed and replaced
+        for attempt in range(2):
+            pool = self.pool
+            try:
+                text = pool.submit(run, command, format, digest, data).result(self.timeout)
+                break
+
+            except BrokenProcessPool:
+                self.restart_pool(pool)
+                if attempt:
+                    raise
+
+            except TimeoutError:
+                with self.lock:
+                    self.timeouts += 1
+                self.restart_pool(pool, kill=True)
+                raise
+
+        self.memory.put(key, text)
+        return text, False
+
+    def record(self, endpoint: str, elapsed: float, failed: bool):
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats.requests += 1
+            stats.errors += failed
+            stats.latencies.append(elapsed)
+
+    def stats(self) -> dict:
+        with self.lock:
+            endpoints = {name: x.stats() for name, x in self.endpoints.items()}
+        return {
+            'uptime s': round(time.time() - self.started, 1),
+            'workers': self.jobs,
+            'pool restarts': self.restarts,
+            'timeouts': self.timeouts,
+            'memory': self.memory.stats(),
+            'endpoints': endpoints
+        }
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive connections, so a client pays for the connection once
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # Headers and body are written separately, without TCP_NODELAY the body waits for the delayed ACK
+        self.disable_nagle_algorithm = self.server.address_family != socket.AF_UNIX
+        super().setup()
+
+    def log_message(self, format, *args):
+        # /stats replaces the access log
+        pass
+
+    def respond(self, status: int, text: str, content_type: str = 'text/plain; charset=utf-8', cached: bool = None):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if cached is not None:
+            self.send_header('X-Cache', 'hit' if cached else 'miss')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/stats':
+            self.respond(200, json.dumps(self.server.luadec.stats(), indent=1) + '\n', 'application/json')
+        else:
+            self.respond(404, 'GET /stats, POST /decompile or POST /disasm?format=text|json\n')
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        command = url.path.strip('/')
+        format = parse_qs(url.query).get('format', ['text'])[0]
+        length = self.headers.get('Content-Length', '0')
+        size = int(length) if length.isdigit() else -1
+
+        if command not in ('decompile', 'disasm') or format not in disasm.FORMATS:
+            self.close_connection = True
+            self.respond(404, 'POST /decompile or POST /disasm?format=text|json\n')
+            return
+
+        if size < 0:
+            self.close_connection = True
+            self.respond(400, f'invalid Content-Length \'{length}\'\n')
+            return
+
+        if size > MAX_REQUEST:
+            self.close_connection = True
+            self.respond(413, f'requests are limited to {MAX_REQUEST} bytes\n')
+            return
+
+        data = self.rfile.read(size)
+        status, cached = 200, None
+        try:
+            text, cached = self.server.luadec.execute(command, format if command == 'disasm' else '', data)
+
+        except BrokenProcessPool:
+            status, text = 500, 'a worker process exited, try again\n'
+
+        except TimeoutError:
+            status, text = 504, f'the request took longer than {self.server.luadec.timeout} s\n'
+
+        except Exception as e:
+            status, text = 422, f'{type(e).__name__}: {e}\n'
+
+        content_type = 'application/x-ndjson' if status == 200 and format == 'json' and command == 'disasm' else \
+            'text/plain; charset=utf-8'
+        self.respond(status, text, content_type, cached)
+        self.server.luadec.record(command, time.perf_counter() - start, status != 200)
+
+
+class LocalHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that close the connection early are no error of the server
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class UnixHTTPServer(LocalHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a host and a port
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve(server: Server, address):
+    # address is the path of a Unix socket or a (host, port) pair
+    if isinstance(address, tuple):
+        http = LocalHTTPServer(address, Handler)
+        name = f'http://{address[0]}:{http.server_port}'
+    else:
+        if Path(address).is_socket():
+            os.remove(address)
+        http = UnixHTTPServer(address, Handler)
+        name = address
+
+    http.luadec = server
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f'listening on {name} with {server.jobs} workers')
+
+    try:
+        http.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        http.server_close()
+        server.close()
+        if not isinstance(address, tuple):
+            os.remove(address)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Keeps the decompiler running and answers requests on a Unix socket or a local port. '
+                    'POST /decompile returns the Lua source and POST /disasm?format=text|json the disassembly of a '
+                    'chunk file of unmunge.py, a \'scr_\' chunk or Lua 4.0 bytecode. GET /stats returns the cache '
+                    'statistics and the latency percentiles.')
+    parser.add_argument('--socket', metavar='PATH', help='listen on the Unix socket PATH')
+    parser.add_argument('--host', default='127.0.0.1', help='without --socket, the address to listen on (127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8040, help='without --socket, the port to listen on (8040)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, metavar='N',
+                        help='number of worker processes (one per CPU)')
+    parser.add_argument('--memory', type=float, default=64.0, metavar='MB',
+                        help='size limit of the responses kept in memory, least recently used ones are removed')
+    parser.add_argument('--chunks', type=int, default=256, metavar='N',
+                        help='decoded chunks kept by every worker process')
+    parser.add_argument('--cache', metavar='FOLDER',
+                        help='reuse decompiled scripts and nested functions with the same bytecode from FOLDER')
+    parser.add_argument('--cache-size', type=float, default=256.0, metavar='MB',
+                        help='with --cache, size limit of the cache folder, least recently used entries are removed')
+    parser.add_argument('--timeout', type=float, default=30.0, metavar='S',
+                        help='requests that take longer fail and their workers are restarted, 0 for no limit (30)')
+
+    args = parser.parse_args()
+
+    server = Server(max(1, args.jobs), int(args.memory * 1e6), max(1, args.chunks), args.cache,
+                    int(args.cache_size * 1e6), args.timeout or None)
+    serve(server, args.socket or (args.host, args.port))
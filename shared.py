@@ -1,3 +1,23 @@
+from collections.abc import Sequence
+
+# Pool of the string constants and function names of all parsed and loaded functions. Every script repeats the same
+# global names, with the pool equal strings of all functions and files share one object
+strings = {}
+interning = True
+
+
+def configure_interning(enabled: bool):
+    global interning
+    interning = enabled
+    strings.clear()
+
+
+def intern(value: str) -> str:
+    if not interning:
+        return value
+    return strings.setdefault(value, value)
+
+
 class Chunk:
     def __init__(self, name, line: int, parameters: int, variadic: bool, stacks: int,
                  locals: list, lines: list, strings: list, numbers: list, functions: list, instructions):
@@ -13,26 +33,97 @@ class Chunk:
         self.functions = functions
         self.instructions = instructions
 
+    def __getstate__(self):
+        # The decoded instruction table (see lua4.decode) and the hash (see cache.chunk_hash) are rebuilt after loading
+        state = self.__dict__.copy()
+        state.pop('decoded', None)
+        state.pop('hash', None)
+        # Chunks of chunkfile.loads have views on the file buffer, which cannot be pickled
+        if not isinstance(state['instructions'], list):
+            state['instructions'] = list(state['instructions'])
+        return state
+
+    def __setstate__(self, state):
+        state['name'] = intern(state['name'])
+        state['strings'] = list(map(intern, state['strings']))
+        self.__dict__.update(state)
+
+    def summary(self, indent: int = 0) -> str:
+        # Only the counts of this function, nested functions are not decoded
+        ind = '  ' * indent
+        return f'{ind}{self.name} ({self.parameters}) L:{self.line} v:{self.variadic} S:{self.stacks}\n' \
+               f'{ind}- Locals       {len(self.locals)}\n' \
+               f'{ind}- Lines        {len(self.lines)}\n' \
+               f'{ind}- Strings      {len(self.strings)}\n' \
+               f'{ind}- Numbers      {len(self.numbers)}\n' \
+               f'{ind}- Instructions {len(self.instructions)}\n' \
+               f'{ind}- Functions    {len(self.functions)}\n'
+
     def __str__(self):
         def p(chunk: Chunk, indent: int = 0):
-            ind = '  ' * indent
-            functions = '' if not chunk.functions else ''.join([p(x, indent + 1) for x in chunk.functions])
-            return '{}{} ({}) L:{} v:{} S:{}\n' \
-                   '{}- Locals       {}\t{}\n' \
-                   '{}- Lines        {}\t{}\n' \
-                   '{}- Strings      {}\t{}\n' \
-                   '{}- Numbers      {}\t{}\n' \
-                   '{}- Instructions {}\t{}\n' \
-                   '{}- Functions    {}\t{}\n' \
-                   '{}'.format(
-                ind, chunk.name, chunk.parameters, chunk.line, chunk.variadic, chunk.stacks,
-                ind, len(chunk.locals), '', #chunk.locals,
-                ind, len(chunk.lines), '',  # chunk.lines,
-                ind, len(chunk.strings), '',  # chunk.strings,
-                ind, len(chunk.numbers), '',  # chunk.numbers,
-                ind, len(chunk.instructions), '',  # chunk.instructions
-                ind, len(chunk.functions), '',  # chunk.functions
-                functions
-            )
+            return chunk.summary(indent) + ''.join(p(x, indent + 1) for x in chunk.functions)
 
         return p(self)
+
+
+def count_instructions(chunk: Chunk) -> int:
+    return len(chunk.instructions) + sum(count_instructions(x) for x in chunk.functions)
+
+
+def functions(chunk: Chunk, path: str = ''):
+    # All functions, parents before their nested functions, with the paths of inspector.py. The main function has
+    # the empty path
+    yield path, chunk
+    for i, function in enumerate(chunk.functions):
+        yield from functions(function, f'{path}.{i}' if path else str(i))
+
+
+# List whose items are created by load(index) the first time they are accessed
+class LazyList(Sequence):
+    def __init__(self, length: int, load):
+        self._items = [None] * length
+        self._loaded = [False] * length
+        self._load = load
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if not self._loaded[index]:
+            self._items[index] = self._load(range(len(self))[index])
+            self._loaded[index] = True
+
+        return self._items[index]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+# Chunk whose locals, lines, constants, nested functions and instructions are decoded on first access.
+# 'loaders' maps each of these attribute names to a function returning its value.
+class LazyChunk(Chunk):
+    def __init__(self, name, line: int, parameters: int, variadic: bool, stacks: int, loaders: dict):
+        self.name = name
+        self.line = line
+        self.parameters = parameters
+        self.variadic = variadic
+        self.stacks = stacks
+        self._loaders = loaders
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet
+        loaders = self.__dict__.get('_loaders', {})
+        if name not in loaders:
+            raise AttributeError(name)
+
+        value = loaders.pop(name)()
+        setattr(self, name, value)
+        return value
+
+    def __reduce__(self):
+        # Pickles as a plain Chunk, nested functions included
+        return Chunk, (self.name, self.line, self.parameters, self.variadic, self.stacks, self.locals, self.lines,
+                       self.strings, self.numbers, list(self.functions), list(self.instructions))
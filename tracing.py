@@ -0,0 +1,24 @@
+import sys
+
+# Trace levels, each level includes the ones before it
+OFF, DEBUG, TRACE = range(3)
+LEVELS = {'off': OFF, 'debug': DEBUG, 'trace': TRACE}
+
+level = OFF
+out = sys.stderr
+
+
+def configure(new_level: int, file=None):
+    global level, out
+    level = new_level
+    out = sys.stderr if file is None else file
+
+
+def enabled(at: int) -> bool:
+    return level >= at
+
+
+def log(at: int, *args):
+    # Hot loops check enabled() once up front instead of calling this per instruction
+    if level >= at:
+        print(*args, file=out)
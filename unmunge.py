@@ -1,189 +1,568 @@
+import io
+import os
 import sys
+import mmap
+import argparse
 import struct
 import math
+import json
 import pickle
+import hashlib
+import cProfile
+import functools
+import contextlib
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
-from shared import Chunk
+import chunkfile
+import profiling
+from shared import Chunk, LazyChunk, LazyList, count_instructions, intern
 
 
-def get_int32(it: iter) -> int:
-    v = next(it)
-    v += (next(it) << 8)
-    v += (next(it) << 16)
-    v += (next(it) << 24)
+class Reader:
+    def __init__(self, buffer, pos: int = 0):
+        self.buffer = memoryview(buffer)
+        self.pos = pos
+
+    def __bool__(self):
+        return self.pos < len(self.buffer)
+
+
+INT32 = struct.Struct('<I')
+FLOAT = struct.Struct('<f')
+
+INDEX_VERSION = 2
+
+
+def get_int32(r: Reader) -> int:
+    v = INT32.unpack_from(r.buffer, r.pos)[0]
+    r.pos += 4
     return v
 
 
-def get_bytes(it: iter, n: int) -> bytearray:
-    b = bytearray(n)
-    for i in range(n):
-        b[i] += next(it)
-    return b
+def get_int32s(r: Reader, n: int) -> list:
+    v = struct.unpack_from(f'<{n}I', r.buffer, r.pos)
+    r.pos += 4 * n
+    return list(v)
+
 
+def get_floats(r: Reader, n: int) -> list:
+    v = struct.unpack_from(f'<{n}f', r.buffer, r.pos)
+    r.pos += 4 * n
+    return list(v)
 
-def get_bytes_aligned(it: iter, n: int = 1) -> bytearray:
-    b = get_bytes(it, n)
 
-    while n % 4 != 0:
-        next(it)
-        n += 1
+def get_bytes(r: Reader, n: int) -> memoryview:
+    if r.pos + n > len(r.buffer):
+        raise EOFError(f'Unexpected end of data at {r.pos} (+{n} bytes)')
 
+    b = r.buffer[r.pos:r.pos + n]
+    r.pos += n
     return b
 
 
-def get_param(it: iter) -> bytearray:
-    read_magic(it)
-    param_size = get_int32(it)
-    return get_bytes_aligned(it, param_size)
+def get_bytes_aligned(r: Reader, n: int = 1) -> memoryview:
+    b = get_bytes(r, n)
+    r.pos += -n % 4
+    return b
 
 
-def read_magic(it: iter) -> bytearray:
-    return get_bytes(it, 4)
+def skip_bytes(r: Reader, n: int):
+    r.pos += n
 
 
-def read_lvl_(it: iter, folder: Path):
-    chunk_name = read_magic(it).decode('latin-1')
-    chunk_size = get_int32(it)
+def get_string(r: Reader, n: int) -> str:
+    # Strings are stored with a trailing '\0'
+    return intern(str(get_bytes(r, n)[:-1], 'latin-1'))
 
-    if chunk_name == 'scr_':
-        name, size, chunk = read_scr_(it)
 
-        print(f'{name} ({size} bytes)')
-        with open(folder / (name + '.dat'), 'wb') as file:
-            pickle.dump(chunk, file)
+def get_param(r: Reader) -> memoryview:
+    read_magic(r)
+    param_size = get_int32(r)
+    return get_bytes_aligned(r, param_size)
 
-    elif chunk_name == 'lvl_':
-        get_int32(it)
-        get_int32(it)
 
-    else:
-        get_bytes(it, chunk_size)
+def read_magic(r: Reader) -> str:
+    return str(get_bytes(r, 4), 'latin-1')
+
+
+def index_lvl_(r: Reader) -> list:
+    index = []
+
+    while r:
+        offset = r.pos
+
+        try:
+            chunk_name = read_magic(r)
+            chunk_size = get_int32(r)
+            script_name = None
+            digest = None
+
+            if chunk_name == 'scr_':
+                script_name = read_scr_name(r)
+                get_param(r)
+                get_param(r)
+                digest = hashlib.blake2b(r.buffer[offset + 8:offset + 8 + chunk_size], digest_size=16).hexdigest()
 
+            elif chunk_name == 'lvl_':
+                get_int32(r)
+                get_int32(r)
+
+            else:
+                skip_bytes(r, chunk_size)
+
+        except Exception as e:
+            print(f'Chunk at {offset}: {e}')
+            break
+
+        index.append((chunk_name, offset, chunk_size, script_name, digest))
+
+    return index
+
+
+# The index of a container, or manifest, lists the offset, size and content hash of every chunk. It is stored
+# next to the extracted scripts as 'folder/<input name>.idx', together with the size and modification time of
+# the input and the format of the extracted scripts.
+def index_file(file, folder: Path) -> Path:
+    return folder / (Path(file).name + '.idx')
+
+
+def read_manifest(index_file: Path):
     try:
-        read_lvl_(it, folder)
+        with open(index_file) as file:
+            manifest = json.load(file)
+
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('version') != INDEX_VERSION:
+        return None
+
+    return manifest
+
+
+def unchanged(manifest, stat: os.stat_result) -> bool:
+    return manifest is not None and manifest['size'] == stat.st_size and manifest['mtime'] == stat.st_mtime_ns
+
+
+def save_index(index_file: Path, stat: os.stat_result, index: list, pickled: bool = False):
+    with open(index_file, 'w') as file:
+        json.dump({
+            'version': INDEX_VERSION,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'pickled': pickled,
+            'chunks': index
+        }, file)
+
 
-    except StopIteration:
-        pass
+def extracted_hashes(manifest, folder: Path, pickled: bool) -> dict:
+    # Content hash of every script that was extracted in the same format and still exists
+    if manifest is None or manifest.get('pickled') != pickled:
+        return {}
+
+    return {
+        script_name: digest for chunk_name, offset, chunk_size, script_name, digest in manifest['chunks']
+        if chunk_name == 'scr_' and (folder / (script_name + '.dat')).exists()
+    }
+
+
+def changed_scripts(index: list, previous: dict) -> list:
+    return [entry for entry in index if entry[0] == 'scr_' and previous.get(entry[3]) != entry[4]]
+
+
+def read_lvl_(r: Reader, folder: Path, index: list, pickled: bool = False):
+    for chunk_name, offset, chunk_size, script_name, digest in index:
+        if chunk_name == 'scr_':
+            extract_scr_(r, folder, offset, script_name, pickled)
+
+
+def extract_scr_(r: Reader, folder: Path, offset: int, script_name: str, pickled: bool = False):
+    r.pos = offset + 8
+    profiling.begin('script', script_name)
+
+    try:
+        with profiling.phase('decode'):
+            name, size, chunk = read_scr_(r)
 
     except Exception as e:
-        print(e)
+        print(f'{script_name}: {e}')
+        return
+
+    print(f'{name} ({size} bytes)')
+    with profiling.phase('write'), open(folder / (name + '.dat'), 'wb') as file:
+        if pickled:
+            pickle.dump(chunk, file)
+        else:
+            chunkfile.dump(chunk, file)
 
+    if profiling.enabled():
+        profiling.count('bytes', size)
+        profiling.count('instructions', count_instructions(chunk))
 
-def read_scr_(it: iter) -> (str, int, Chunk):
-    name = get_param(it)[:-1].decode('latin-1')
-    info = get_param(it)
-    body = get_param(it)
+
+def read_scr_name(r: Reader) -> str:
+    return str(get_param(r)[:-1], 'latin-1')
+
+
+def read_scr_(r: Reader) -> (str, int, Chunk):
+    name = read_scr_name(r)
+    info = get_param(r)
+    body = get_param(r)
 
     return name, len(body), handle_script(body)
 
 
-def handle_script(body: bytes) -> Chunk:
-    it = iter(body)
-    assert (next(it) == 0x1B)  # .
-    assert (next(it) == 0x4C)  # L
-    assert (next(it) == 0x75)  # u
-    assert (next(it) == 0x61)  # a
-    assert (next(it) == 0x40)  # @  (4.0)
-
-    endianness = next(it)
-    size_int_bytes = next(it)
-    size_size_t_bytes = next(it)
-    size_instruction_bytes = next(it)
-    size_instruction_bits = next(it)
-    size_op_bits = next(it)
-    size_b_bits = next(it)
-    size_test_number_bits = next(it)
-
-    test_number = struct.unpack('f', get_bytes(it, size_test_number_bits))
+def handle_script(body, lazy: bool = False) -> Chunk:
+    r = Reader(body)
+    assert (get_bytes(r, 5) == b'\x1bLua@')  # .Lua@  (4.0)
+
+    endianness, \
+        size_int_bytes, \
+        size_size_t_bytes, \
+        size_instruction_bytes, \
+        size_instruction_bits, \
+        size_op_bits, \
+        size_b_bits, \
+        size_test_number_bits = get_bytes(r, 8)
+
+    test_number = FLOAT.unpack(get_bytes(r, size_test_number_bits))[0]
     assert (math.isclose(test_number == 3.14159265358979323846E8, 0))
 
-    chunk = handle_chunk(it, size_instruction_bytes, size_op_bits, size_b_bits)
+    if lazy:
+        return handle_lazy_chunk(r)
+
+    chunk = handle_chunk(r, size_instruction_bytes, size_op_bits, size_b_bits)
 
     return chunk
 
 
-def handle_chunk(it, size_instruction_bytes, size_op_bits: int, size_b_bits: int) -> Chunk:
-    name_size = get_int32(it)
-    name = get_bytes(it, name_size)[:-1].decode('latin-1')
+def get_blobs(r: Reader) -> list:
+    return [bytearray(get_bytes(r, get_int32(r))) for _ in range(get_int32(r))]
+
+
+def get_strings(r: Reader) -> list:
+    return [get_string(r, get_int32(r)) for _ in range(get_int32(r))]
+
+
+def get_numbers(r: Reader) -> list:
+    return get_floats(r, get_int32(r))
+
+
+def get_instructions(r: Reader) -> list:
+    return get_int32s(r, get_int32(r))
 
-    line = get_int32(it)
-    parameters = get_int32(it)
-    variadic = get_bytes(it, 1) == 0x01
-    stacks = get_int32(it)
+
+def skip_sized(r: Reader):
+    for _ in range(get_int32(r)):
+        skip_bytes(r, get_int32(r))
+
+
+def handle_chunk(r: Reader, size_instruction_bytes, size_op_bits: int, size_b_bits: int) -> Chunk:
+    name_size = get_int32(r)
+    name = get_string(r, name_size)
+
+    line = get_int32(r)
+    parameters = get_int32(r)
+    variadic = get_bytes(r, 1)[0] == 0x01
+    stacks = get_int32(r)
 
     # Locals
     # Note: SWBF does not seem to save local variable names
-    num_locals = get_int32(it)
-    locals = []
-    for i in range(num_locals):
-        size = get_int32(it)
-        locals.append(get_bytes(it, size))
+    locals = get_blobs(r)
 
     # Lines
-    num_lines = get_int32(it)
-    lines = []
-    for i in range(num_lines):
-        size = get_int32(it)
-        lines.append(get_bytes(it, size))
+    lines = get_blobs(r)
 
     # Constants
 
     # - Strings
-    num_strings = get_int32(it)
-    strings = []
-    for i in range(num_strings):
-        size = get_int32(it)
-        strings.append(get_bytes(it, size)[:-1].decode('latin-1'))
+    strings = get_strings(r)
 
     # - Numbers
-    num_numbers = get_int32(it)
-    numbers = []
-    for i in range(num_numbers):
-        numbers.append(struct.unpack('f', get_bytes(it, 4))[0])
+    numbers = get_numbers(r)
 
     # - Functions
-    num_functions = get_int32(it)
+    num_functions = get_int32(r)
     functions = []
     for i in range(num_functions):
-        functions.append(handle_chunk(it, size_instruction_bytes, size_op_bits, size_b_bits))
+        functions.append(handle_chunk(r, size_instruction_bytes, size_op_bits, size_b_bits))
 
     # Instruction
-    num_instruction = get_int32(it)
-    instructions = []
-    for i in range(num_instruction):
-        instructions.append(get_int32(it))
+    instructions = get_instructions(r)
 
     return Chunk(name, line, parameters, variadic, stacks, locals, lines, strings, numbers, functions, instructions)
 
 
-def main(file, folder: Path):
-    it = iter(bytes(open(file, 'rb').read()))
-    try:
-        assert (next(it) == 0x75)  # u
-        assert (next(it) == 0x63)  # c
-        assert (next(it) == 0x66)  # f
-        assert (next(it) == 0x62)  # b
+def skip_chunk(r: Reader):
+    skip_bytes(r, get_int32(r))
+    skip_bytes(r, 4 + 4 + 1 + 4)
+
+    skip_sized(r)
+    skip_sized(r)
+    skip_sized(r)
+    skip_bytes(r, 4 * get_int32(r))
+
+    for _ in range(get_int32(r)):
+        skip_chunk(r)
+
+    skip_bytes(r, 4 * get_int32(r))
 
-        file_size = get_int32(it)
 
-        read_lvl_(it, folder)
+def handle_lazy_chunk(r: Reader) -> LazyChunk:
+    name_size = get_int32(r)
+    name = get_string(r, name_size)
 
-    except StopIteration as e:
-        pass
+    line = get_int32(r)
+    parameters = get_int32(r)
+    variadic = get_bytes(r, 1)[0] == 0x01
+    stacks = get_int32(r)
+
+    # Only the section offsets are recorded, the sections are decoded on first access
+    buffer = r.buffer
+
+    def section(decode):
+        pos = r.pos
+        return lambda: decode(Reader(buffer, pos))
+
+    locals = section(get_blobs)
+    skip_sized(r)
+
+    lines = section(get_blobs)
+    skip_sized(r)
+
+    strings = section(get_strings)
+    skip_sized(r)
+
+    numbers = section(get_numbers)
+    skip_bytes(r, 4 * get_int32(r))
+
+    num_functions = get_int32(r)
+    function_offsets = []
+    for i in range(num_functions):
+        function_offsets.append(r.pos)
+        skip_chunk(r)
+
+    instructions = section(get_instructions)
+    skip_bytes(r, 4 * get_int32(r))
+
+    return LazyChunk(name, line, parameters, variadic, stacks, {
+        'locals': locals,
+        'lines': lines,
+        'strings': strings,
+        'numbers': numbers,
+        'functions': lambda: LazyList(num_functions, lambda i: handle_lazy_chunk(Reader(buffer, function_offsets[i]))),
+        'instructions': instructions
+    })
+
+
+def read_ucfb(r: Reader) -> list:
+    assert (get_bytes(r, 4) == b'ucfb')
+
+    file_size = get_int32(r)
+
+    return index_lvl_(r)
+
+
+def open_reader(file, mapped: bool = False) -> Reader:
+    with open(file, 'rb') as f:
+        if not mapped:
+            return Reader(f.read())
+
+        # Map the container instead of reading it, only the chunk headers and the scr_ bodies are paged in
+        return Reader(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def get_index(file, folder: Path, r: Reader, pickled: bool = False, save: bool = True):
+    # The chunk index is stored next to the extracted scripts and reused as long as the input is unchanged
+    stat = os.stat(file)
+    manifest = read_manifest(index_file(file, folder))
+
+    if unchanged(manifest, stat):
+        index = [tuple(entry) for entry in manifest['chunks']]
+
+        if save and manifest['pickled'] != pickled:
+            save_index(index_file(file, folder), stat, index, pickled)
+        return index
+
+    try:
+        index = read_ucfb(r)
 
     except Exception as e:
         print(e)
+        return None
+
+    if save:
+        save_index(index_file(file, folder), stat, index, pickled)
+
+    return index
+
+
+def main(file, folder: Path, mapped: bool = False, pickled: bool = False, incremental: bool = False):
+    profiling.begin('file', file, os.stat(file).st_size if profiling.enabled() else 0)
+
+    if not incremental:
+        with profiling.phase('read'):
+            r = open_reader(file, mapped)
+        with profiling.phase('index'):
+            index = get_index(file, folder, r, pickled)
+
+        if index is not None:
+            read_lvl_(r, folder, index, pickled)
+        return
+
+    # Incremental: inputs with the size and modification time of the manifest are not read at all, of the other
+    # inputs only the scr_ chunks whose content hash differs from the manifest are decoded and written
+    stat = os.stat(file)
+    manifest = read_manifest(index_file(file, folder))
+    previous = extracted_hashes(manifest, folder, pickled)
+
+    if unchanged(manifest, stat) and not changed_scripts(manifest['chunks'], previous):
+        print(f'{file}: unchanged')
+        return
+
+    with profiling.phase('read'):
+        r = open_reader(file, mapped)
+    with profiling.phase('index'):
+        index = get_index(file, folder, r, pickled, save=False)
+
+    if index is not None:
+        changed = changed_scripts(index, previous)
+        read_lvl_(r, folder, changed, pickled)
+        print(f'{file}: {len(changed)} of {len(changed_scripts(index, {}))} scripts extracted')
+
+        # Saved last, so an interrupted run extracts the same scripts again
+        save_index(index_file(file, folder), stat, index, pickled)
+
+
+@functools.lru_cache(maxsize=4)
+def map_file(file) -> mmap.mmap:
+    with open(file, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def extract_file_scr_(file, folder: Path, offset: int, script_name: str, pickled: bool = False):
+    # Worker processes keep the container mapped between the scr_ chunks of the same file
+    extract_scr_(Reader(map_file(file)), folder, offset, script_name, pickled)
+
+
+def run_captured(function, *args) -> str:
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        try:
+            function(*args)
+
+        except Exception as e:
+            print(e)
+
+    return output.getvalue()
+
+
+def run_profiled(function, *args) -> (str, list):
+    # The records of a worker process are merged into the report of the main process
+    profiling.configure(True)
+    return run_captured(function, *args), profiling.records
+
+
+def main_parallel(files: list, jobs: int, mapped: bool = False, split: bool = False, pickled: bool = False,
+                  incremental: bool = False):
+    run = run_profiled if profiling.enabled() else run_captured
+
+    with ProcessPoolExecutor(jobs) as pool:
+        # The tasks of every file and the line printed after their output, in input order
+        files_tasks = []
+        manifests = []
+
+        for file in files:
+            folder = output_folder(file)
+
+            if not split:
+                files_tasks.append(([pool.submit(run, main, file, folder, mapped, pickled, incremental)], None))
+                continue
+
+            stat = os.stat(file)
+            previous = {}
+            if incremental:
+                manifest = read_manifest(index_file(file, folder))
+                previous = extracted_hashes(manifest, folder, pickled)
+
+                if unchanged(manifest, stat) and not changed_scripts(manifest['chunks'], previous):
+                    files_tasks.append(([], f'{file}: unchanged'))
+                    continue
+
+            profiling.begin('file', file, stat.st_size)
+            with profiling.phase('index'):
+                index = get_index(file, folder, open_reader(file, mapped=True), pickled, save=not incremental)
+            changed = changed_scripts(index or [], previous)
+            tasks = [pool.submit(run, extract_file_scr_, file, folder, offset, script_name, pickled)
+                     for chunk_name, offset, chunk_size, script_name, digest in changed]
+
+            # The same summary as main prints for an incremental run
+            summary = None
+            if incremental and index is not None:
+                manifests.append((index_file(file, folder), stat, index))
+                summary = f'{file}: {len(changed)} of {len(changed_scripts(index, {}))} scripts extracted'
+            files_tasks.append((tasks, summary))
+
+        # Output is printed in input order, regardless of which worker finishes first
+        for tasks, summary in files_tasks:
+            for task in tasks:
+                output = task.result()
+                if profiling.enabled():
+                    output, records = output
+                    profiling.records.extend(records)
+                print(output, end='')
+
+            if summary is not None:
+                print(summary)
+
+        for manifest in manifests:
+            save_index(*manifest, pickled)
+
+
+def output_folder(file) -> Path:
+    folder = Path(Path(file).stem)
+    folder.mkdir(exist_ok=True)
+    return folder
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Only files containing a \'scr_\' chunk will produce a \'*.dat\' file which contains '
+                    'a Lua 4.0 program stored as a binary \'Chunk\' structure which contains the bytecode.')
+    parser.add_argument('files', nargs='+', help='\'*.lvl\' or \'*.script\' files')
+    parser.add_argument('--mmap', action='store_true', help='memory-map the input files instead of reading them')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help='number of worker processes')
+    parser.add_argument('--split', action='store_true',
+                        help='with --jobs, also spread the \'scr_\' chunks of each file across the workers')
+    parser.add_argument('--pickle', action='store_true', help='write pickled \'Chunk\' structures (old format)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip unchanged files and only extract the \'scr_\' chunks that changed since the last run')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write the wall and CPU time of the phases of every file and script to FILE as JSON')
+    parser.add_argument('--profile-dump', metavar='FILE',
+                        help='write cProfile statistics of the main process to FILE')
+
     if len(sys.argv) < 2:
-        print('Pass one or more \'*.lvl\' files as arguments.\n\n'
-              'Only files containing a \'scr_\' chunk will produce a \'*.dat\' file which contains '
-              'a Lua 4.0 program stored in a pickled \'Chunk\' structure which contains the bytecode.')
+        print('Pass one or more \'*.lvl\' files as arguments.\n')
+        parser.print_help()
         exit(1)
 
-    for file in sys.argv[1:]:
-        folder = Path(Path(file).stem)
-        folder.mkdir(exist_ok=True)
-        main(file, folder)
+    args = parser.parse_args()
+
+    profiling.configure(args.profile is not None)
+    profiler = cProfile.Profile() if args.profile_dump else None
+    if profiler:
+        profiler.enable()
+
+    if args.jobs > 1:
+        main_parallel(args.files, args.jobs, args.mmap, args.split, args.pickle, args.incremental)
+    else:
+        for file in args.files:
+            main(file, output_folder(file), args.mmap, args.pickle, args.incremental)
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile_dump)
+
+    if args.profile:
+        profiling.write('unmunge', args.profile)